@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the r.in.usgs download writer
+
+Serves random data from a local HTTP server and compares download
+throughput (MB/s) of the original fixed 16 KiB read loop reporting
+progress for each chunk with the download engine of r.in.usgs.
+Run within a GRASS session (progress messages go to stderr):
+
+    python download_benchmark.py [size_mb] [repeat]
+"""
+
+import os
+import sys
+import imp
+import hashlib
+import time
+import shutil
+import tempfile
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+import grass.script as gscript
+
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'r.in.usgs.py')
+
+
+class DataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    data = ''
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        step = 1024 * 1024
+        for start in range(0, len(self.data), step):
+            self.wfile.write(self.data[start:start + step])
+
+
+class DataServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_server(size):
+    DataHandler.data = os.urandom(size)
+    server = DataServer(('127.0.0.1', 0), DataHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:{0}/data'.format(server.server_port)
+
+
+def baseline_download(url, local_file_path):
+    """Fixed 16 KiB read loop reporting progress for each chunk
+
+    The data are checksummed as in the download engine,
+    so that both compute the same.
+    """
+    dwnld_req = urllib2.urlopen(url, timeout=12)
+    download_bytes = int(dwnld_req.info()['Content-Length'])
+    checksum = hashlib.md5()
+    CHUNK = 16 * 1024
+    with open(local_file_path, "wb+") as local_file:
+        count = 0
+        steps = int(download_bytes / CHUNK) + 1
+        while True:
+            chunk = dwnld_req.read(CHUNK)
+            gscript.percent(count, steps, 10)
+            count += 1
+            if not chunk:
+                break
+            local_file.write(chunk)
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def engine_download(module, url, local_file_path, size):
+    progress = module.DownloadProgress(size, 1)
+    module.download_file(url, local_file_path, progress, size=size)
+    module.close_connections()
+
+
+def measure(function, size, repeat):
+    """Return best throughput in MB/s of repeated runs"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return size / (1024. * 1024) / best
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 256) * 1024 * 1024
+    repeat = int(sys.argv[2] if len(sys.argv) > 2 else 3)
+    module = imp.load_source('r_in_usgs', MODULE_PATH)
+    url = start_server(size)
+    work_dir = tempfile.mkdtemp()
+    path = os.path.join(work_dir, 'tile')
+    try:
+        baseline = measure(lambda: baseline_download(url, path), size, repeat)
+        os.remove(path)
+        engine = measure(lambda: engine_download(module, url, path, size),
+                         size, repeat)
+    finally:
+        shutil.rmtree(work_dir)
+    sys.stdout.write("file size:  {0} MB\n".format(size // (1024 * 1024)))
+    sys.stdout.write("baseline:   {0:.1f} MB/s\n".format(baseline))
+    sys.stdout.write("engine:     {0:.1f} MB/s\n".format(engine))
+    sys.stdout.write("speedup:    {0:.2f}x\n".format(engine / baseline))
+
+
+if __name__ == '__main__':
+    main()
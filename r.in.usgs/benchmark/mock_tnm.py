@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Mock of the USGS TNM API products endpoint and file server
+
+Serves synthetic tiles of NED (IMG in ZIP), NLCD (GeoTIFF in ZIP) and
+NAIP (JPEG2000) products laid out on a regular grid in geographic
+coordinates. Tile count, tile size, latency and bandwidth are
+configurable. Used by run_benchmark.py, it can also be started alone
+(requires GDAL Python bindings):
+
+    python mock_tnm.py [--tiles 16] [--tile-size 512] [--port 8000]
+
+and r.in.usgs pointed to it:
+
+    export R_IN_USGS_TNM_URL="http://127.0.0.1:8000/api/products?"
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import array
+import random
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from osgeo import gdal, osr
+
+
+# tile extent in degrees and the dataset name as queried by r.in.usgs
+PRODUCTS = {
+    'ned': {
+        'dataset': 'National Elevation Dataset (NED) 1/3 arc-second',
+        'tile_degrees': 0.25,
+        'bands': 1,
+        'type': gdal.GDT_Float32,
+        'driver': 'HFA',
+        'extension': 'img',
+        'zip': True,
+        'title': 'USGS NED 1/3 arc-second tile {0} 15 x 15 minute IMG',
+        'name': 'USGS_NED_13_tile{0:04d}',
+        },
+    'nlcd': {
+        'dataset': 'National Land Cover Database (NLCD) - 2011',
+        'tile_degrees': 0.25,
+        'bands': 1,
+        'type': gdal.GDT_Byte,
+        'driver': 'GTiff',
+        'extension': 'tif',
+        'zip': True,
+        'title': 'NLCD 2011 Land Cover tile {0} 3 x 3 degree GeoTIFF',
+        'name': 'NLCD2011_LC_tile{0:04d}',
+        },
+    'naip': {
+        'dataset': 'USDA National Agriculture Imagery Program (NAIP)',
+        'tile_degrees': 0.0625,
+        'bands': 4,
+        'type': gdal.GDT_Byte,
+        'driver': 'JP2OpenJPEG',
+        'extension': 'jp2',
+        'zip': False,
+        'title': 'USDA NAIP tile {0} 3.75 x 3.75 minute JPEG2000',
+        'name': 'm_tile{0:04d}',
+        },
+    }
+
+# south-west corner of the tile grid
+ORIGIN = (-79.0, 35.0)
+
+SEND_CHUNK = 64 * 1024
+
+
+def tile_grid(count, tile_degrees):
+    """Return bounding boxes (west, south, east, north) of tiles
+
+    Tiles are laid out row by row in a grid as close to a square
+    as possible.
+    """
+    columns = int(math.ceil(math.sqrt(count)))
+    bboxes = []
+    for i in range(count):
+        west = ORIGIN[0] + (i % columns) * tile_degrees
+        south = ORIGIN[1] + (i // columns) * tile_degrees
+        bboxes.append((west, south, west + tile_degrees, south + tile_degrees))
+    return bboxes
+
+
+def synthetic_data(product, size, seed=0):
+    """Return raster data of a single band as a byte string
+
+    The data compress about as well as the real products:
+    a smooth surface with noise for NED, a few classes for NLCD
+    and noisy imagery for NAIP.
+    """
+    generator = random.Random(seed)
+    if product == 'ned':
+        values = array.array('f', [0.0]) * (size * size)
+        for row in range(size):
+            offset = row * size
+            for column in range(size):
+                values[offset + column] = (300 + 0.05 * row + 0.03 * column +
+                                           generator.random())
+        return values.tostring()
+    noise = bytearray(generator.getrandbits(8) for i in range(size * size))
+    if product == 'nlcd':
+        # patches of classes with scattered cells of other classes
+        classes = bytearray([11, 21, 22, 41, 42, 52, 71, 82])
+        values = bytearray(size * size)
+        for row in range(size):
+            offset = row * size
+            for column in range(size):
+                patch = row // 32 * 7 + column // 32 * 3
+                if noise[offset + column] > 240:
+                    patch += noise[offset + column]
+                values[offset + column] = classes[patch % 8]
+        return bytes(values)
+    return bytes(noise)
+
+
+def write_tile(product, path, bbox, size, data):
+    """Write synthetic tile in the format of the product"""
+    config = PRODUCTS[product]
+    mem = gdal.GetDriverByName('MEM').Create('', size, size, config['bands'],
+                                             config['type'])
+    west, south, east, north = bbox
+    mem.SetGeoTransform((west, (east - west) / size, 0,
+                         north, 0, -(north - south) / size))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4269)
+    mem.SetProjection(srs.ExportToWkt())
+    for band in range(1, config['bands'] + 1):
+        mem.GetRasterBand(band).WriteRaster(0, 0, size, size, data)
+    driver = gdal.GetDriverByName(config['driver'])
+    if driver is None:
+        # without OpenJPEG, GeoTIFF is written under the .jp2 name,
+        # GDAL opens it based on its content
+        driver = gdal.GetDriverByName('GTiff')
+    driver.CreateCopy(path, mem)
+    mem = None
+
+
+def file_md5(path):
+    checksum = hashlib.md5()
+    with open(path, 'rb') as tile_file:
+        for block in iter(lambda: tile_file.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def create_tiles(product, count, size, directory):
+    """Create synthetic tiles of product in directory
+
+    Returns list of dictionaries with file name, size, MD5
+    checksum and bounding box of each tile (as served).
+    """
+    config = PRODUCTS[product]
+    data = synthetic_data(product, size)
+    scratch = tempfile.mkdtemp(dir=directory)
+    tiles = []
+    try:
+        for i, bbox in enumerate(tile_grid(count, config['tile_degrees'])):
+            name = config['name'].format(i)
+            raster_name = '{0}.{1}'.format(name, config['extension'])
+            raster_path = os.path.join(scratch, raster_name)
+            write_tile(product, raster_path, bbox, size, data)
+            if config['zip']:
+                file_name = name + '_' + config['extension'].upper() + '.zip'
+                file_path = os.path.join(directory, file_name)
+                with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                    zip_file.write(raster_path, raster_name)
+                    zip_file.writestr('readme.txt', 'Synthetic tile {0}\n'.format(i))
+                # remove the raster with any sidecar files written by GDAL
+                for sidecar in os.listdir(scratch):
+                    os.remove(os.path.join(scratch, sidecar))
+            else:
+                file_name = raster_name
+                file_path = os.path.join(directory, file_name)
+                shutil.move(raster_path, file_path)
+            tiles.append({'title': config['title'].format(i),
+                          'file': file_name,
+                          'size': os.path.getsize(file_path),
+                          'md5': file_md5(file_path),
+                          'bbox': bbox})
+    finally:
+        shutil.rmtree(scratch)
+    return tiles
+
+
+def bbox_intersects(bbox, other):
+    return (bbox[0] < other[2] and other[0] < bbox[2] and
+            bbox[1] < other[3] and other[1] < bbox[3])
+
+
+class TNMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, content):
+        body = json.dumps(content)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, code, headers=()):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        if path == '/api/products':
+            self.products(dict(urlparse.parse_qsl(query)))
+        elif path.startswith('/files/'):
+            self.send_tile(path[len('/files/'):])
+        else:
+            self.send_empty(404)
+
+    def products(self, query):
+        """Page of items of the product given by the datasets parameter"""
+        server = self.server
+        items = []
+        for product, tiles in server.tiles.items():
+            if PRODUCTS[product]['dataset'] != query.get('datasets'):
+                continue
+            bbox = None
+            if query.get('bbox'):
+                bbox = [float(coord) for coord in query['bbox'].split(',')]
+            for tile in tiles:
+                if bbox and not bbox_intersects(tile['bbox'], bbox):
+                    continue
+                west, south, east, north = tile['bbox']
+                items.append({
+                    'title': tile['title'],
+                    'downloadURL': '{0}/files/{1}'.format(server.url, tile['file']),
+                    'sizeInBytes': tile['size'],
+                    'format': query.get('prodFormats', ''),
+                    'datasets': [PRODUCTS[product]['dataset']],
+                    'boundingBox': {'minX': west, 'minY': south,
+                                    'maxX': east, 'maxY': north}})
+        offset = int(query.get('offset', 0))
+        page_size = int(query.get('max', 10))
+        self.send_json({'total': len(items), 'errors': [],
+                        'items': items[offset:offset + page_size]})
+
+    def send_tile(self, file_name):
+        """Send tile honouring byte ranges, limited to server bandwidth"""
+        server = self.server
+        tile = server.files.get(file_name)
+        if tile is None:
+            self.send_empty(404)
+            return
+        size = tile['size']
+        start = 0
+        range_header = self.headers.getheader('Range')
+        if range_header and range_header.startswith('bytes='):
+            start = int(range_header[len('bytes='):].split('-')[0])
+            if start >= size:
+                self.send_empty(416, [('Content-Range', 'bytes */{0}'.format(size))])
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"{0}"'.format(tile['md5']))
+        self.end_headers()
+        began = time.time()
+        sent = 0
+        with open(os.path.join(server.directory, file_name), 'rb') as tile_file:
+            tile_file.seek(start)
+            for block in iter(lambda: tile_file.read(SEND_CHUNK), b''):
+                self.wfile.write(block)
+                sent += len(block)
+                server.count_bytes(len(block))
+                if server.bandwidth:
+                    ahead = sent / float(server.bandwidth) - (time.time() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+
+class MockTNM(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded server of the TNM API and of synthetic tiles
+
+    Latency (seconds) is added to every request, bandwidth (bytes per
+    second, 0 for unlimited) limits each download connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, products, count, size, latency=0, bandwidth=0,
+                 port=0, directory=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), TNMHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.remove_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix='mock_tnm_')
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server_port)
+        self.tiles = {}
+        self.files = {}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        for product in products:
+            self.tiles[product] = create_tiles(product, count, size, self.directory)
+            for tile in self.tiles[product]:
+                self.files[tile['file']] = tile
+        self.thread = None
+
+    @property
+    def api_url(self):
+        """URL for the R_IN_USGS_TNM_URL environment variable"""
+        return self.url + '/api/products?'
+
+    def count_bytes(self, count):
+        with self.lock:
+            self.bytes_sent += count
+
+    def bbox(self, product):
+        """Return union of tile bounding boxes of product"""
+        bboxes = [tile['bbox'] for tile in self.tiles[product]]
+        return (min(bbox[0] for bbox in bboxes), min(bbox[1] for bbox in bboxes),
+                max(bbox[2] for bbox in bboxes), max(bbox[3] for bbox in bboxes))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.remove_directory:
+            shutil.rmtree(self.directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock of the USGS TNM API")
+    parser.add_argument('--products', default='ned,nlcd,naip')
+    parser.add_argument('--tiles', type=int, default=16, help="tiles per product")
+    parser.add_argument('--tile-size', type=int, default=512, help="tile width in cells")
+    parser.add_argument('--latency', type=float, default=0, help="seconds per request")
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help="MB/s per connection, 0 for unlimited")
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    server = MockTNM(args.products.split(','), args.tiles, args.tile_size,
+                     latency=args.latency,
+                     bandwidth=int(args.bandwidth * 1024 * 1024), port=args.port)
+    server.start()
+    sys.stdout.write("R_IN_USGS_TNM_URL={0}\n".format(server.api_url))
+    for product in server.tiles:
+        sys.stdout.write("{0} tiles in n={4} s={2} e={3} w={1}\n".format(
+            product, *server.bbox(product)))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of r.in.usgs against a mock of the TNM API
+
+Starts a local mock of the TNM API and file server (mock_tnm.py)
+serving synthetic tiles and times r.in.usgs for the ned, nlcd and
+naip products. Run within a GRASS session in a location with
+geographic coordinates, e.g.:
+
+    grass -c EPSG:4269 /tmp/usgs_benchmark --exec \\
+        python run_benchmark.py --tiles 16 --tile-size 1024 --output results.json
+
+The module runs in a temporary mapset which is removed afterwards.
+Time of each stage is derived from runs of the module which perform
+different subsets of the stages:
+
+    query       query only (i flag), includes start of the module
+    cold        query, download, extract, import, patch
+    extracted   query, import, patch (extracted files kept by k flag)
+    downloaded  query, extract, import, patch (extracted files removed)
+    reused      query, patch (tiles imported by previous run with r flag)
+
+The runs above extract files from ZIP archives (e flag) to time the
+extract stage separately. NED and NLCD are timed also on the default
+path, which imports tiles directly from the ZIP archives: runs
+zip_cold, zip_downloaded and zip_reused, and their stages (zip_stages)
+are reported next to those of the extracted path.
+
+The profile of the cold run written by the module (profile option),
+with wall time, busy time and throughput of the stages as they overlap
+in the pipeline and time of the GRASS modules, is included as well.
+
+Downloaded files (and extracted files) are kept by the k flag,
+so the runs after the cold run must not download anything, which is
+checked. NAIP tiles are not packaged in ZIP archives, so there is no
+extract stage (and no extracted run) for naip. Stage times are minimum of
+repeated runs. Results are written as JSON, including the version of
+the module (git commit) so that results of versions can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import grass.script as gscript
+
+from mock_tnm import MockTNM, PRODUCTS
+
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'r.in.usgs.py')
+
+PRODUCT_OPTIONS = {
+    'ned': {'ned_dataset': 'ned13sec'},
+    'nlcd': {'nlcd_dataset': 'nlcd2011', 'nlcd_subset': 'landcover'},
+    'naip': {'naip_composite': 'rgb'},
+    }
+
+
+def module_version():
+    """Return git commit of the module or None outside of git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(MODULE_PATH), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_mapset(name):
+    """Create mapset in current location, return its path and environment"""
+    gisenv = gscript.gisenv()
+    location_path = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'])
+    mapset_path = os.path.join(location_path, name)
+    os.mkdir(mapset_path)
+    shutil.copy(os.path.join(location_path, 'PERMANENT', 'DEFAULT_WIND'),
+                os.path.join(mapset_path, 'WIND'))
+    gisrc = os.path.join(mapset_path, '.gisrc_benchmark')
+    with open(gisrc, 'w') as f:
+        f.write("GISDBASE: {0}\n".format(gisenv['GISDBASE']))
+        f.write("LOCATION_NAME: {0}\n".format(gisenv['LOCATION_NAME']))
+        f.write("MAPSET: {0}\n".format(name))
+    env = os.environ.copy()
+    env['GISRC'] = gisrc
+    return mapset_path, env
+
+
+class Runner(object):
+    """Runs r.in.usgs with common options and measures wall time"""
+
+    def __init__(self, product, work_dir, env, log, options):
+        self.product = product
+        self.work_dir = work_dir
+        self.env = env
+        self.log = log
+        self.options = options
+
+    def run(self, flags='', profile=None):
+        options = dict(self.options)
+        options.update(PRODUCT_OPTIONS[self.product])
+        options.update({'product': self.product,
+                        'output_name': 'benchmark_' + self.product,
+                        'output_directory': self.work_dir,
+                        'query_cache_ttl': 0})
+        if profile:
+            options['profile'] = profile
+        command = [sys.executable, MODULE_PATH, '--overwrite', '--quiet']
+        if flags:
+            command.append('-' + flags)
+        command += ['{0}={1}'.format(key, value) for key, value in sorted(options.items())]
+        self.log.write("\n$ {0}\n".format(' '.join(command[1:])))
+        self.log.flush()
+        start = time.time()
+        returncode = subprocess.call(command, env=self.env, stdout=self.log,
+                                     stderr=self.log)
+        seconds = time.time() - start
+        if returncode:
+            gscript.fatal("r.in.usgs failed, see log {0}".format(self.log.name))
+        return seconds
+
+    def remove_extracted(self):
+        """Remove files extracted from ZIP archives in output directory"""
+        extension = '.' + PRODUCTS[self.product]['extension']
+        for name in os.listdir(self.work_dir):
+            if name.endswith(extension):
+                os.remove(os.path.join(self.work_dir, name))
+
+    def clear(self):
+        shutil.rmtree(self.work_dir)
+        os.mkdir(self.work_dir)
+
+
+def benchmark_product(product, server, env, scratch, log, repeat, options):
+    """Return dictionary with timings of runs and stages for product"""
+    west, south, east, north = server.bbox(product)
+    resolution = PRODUCTS[product]['tile_degrees'] / options['tile_size']
+    gscript.run_command('g.region', n=north, s=south, e=east, w=west,
+                        res=resolution, env=env)
+    runner = Runner(product, os.path.join(scratch, product), env, log,
+                    {'download_workers': options['download_workers'],
+                     'nprocs': options['nprocs']})
+    os.mkdir(runner.work_dir)
+    is_zip = PRODUCTS[product]['zip']
+    keep_flags = 'ek' if is_zip else 'k'
+    runs = {'query': [], 'cold': [], 'downloaded': [], 'reused': []}
+    if is_zip:
+        runs.update(extracted=[], zip_cold=[], zip_downloaded=[], zip_reused=[])
+    bytes_sent = None
+    profile_path = os.path.join(scratch, product + '_profile.json')
+    profiles = []
+
+    def run_local(flags):
+        # run which uses only files downloaded by the cold run
+        sent = server.bytes_sent
+        seconds = runner.run(flags)
+        if server.bytes_sent != sent:
+            gscript.fatal("r.in.usgs -{0} downloaded {1} bytes instead of using local files".format(
+                flags, server.bytes_sent - sent))
+        return seconds
+
+    for i in range(repeat):
+        runner.clear()
+        runs['query'].append(runner.run('i'))
+        sent = server.bytes_sent
+        runs['cold'].append(runner.run(keep_flags, profile=profile_path))
+        bytes_sent = server.bytes_sent - sent
+        with open(profile_path) as profile_file:
+            profiles.append(json.load(profile_file))
+        if is_zip:
+            runs['extracted'].append(run_local(keep_flags))
+            runner.remove_extracted()
+        runs['downloaded'].append(run_local(keep_flags))
+        run_local(keep_flags + 'r')
+        runs['reused'].append(run_local(keep_flags + 'r'))
+        if is_zip:
+            # default path, tiles are read from ZIP archives in place
+            runner.clear()
+            runs['zip_cold'].append(runner.run('k'))
+            runs['zip_downloaded'].append(run_local('k'))
+            run_local('kr')
+            runs['zip_reused'].append(run_local('kr'))
+    runner.clear()
+
+    best = dict((name, min(times)) for name, times in runs.items())
+    # stages and modules as profiled by the module in the fastest cold run
+    profile = profiles[runs['cold'].index(best['cold'])]
+    imported = best['extracted'] if is_zip else best['downloaded']
+    stages = {
+        'query': best['query'],
+        'download': best['cold'] - best['downloaded'],
+        'extract': best['downloaded'] - best['extracted'] if is_zip else None,
+        'import': imported - best['reused'],
+        'patch': best['reused'] - best['query'],
+        }
+    zip_stages = None
+    if is_zip:
+        zip_stages = {
+            'query': best['query'],
+            'download': best['zip_cold'] - best['zip_downloaded'],
+            'import': best['zip_downloaded'] - best['zip_reused'],
+            'patch': best['zip_reused'] - best['query'],
+            }
+    # differences of noisy measurements can get slightly negative
+    for stages_of_path in (stages, zip_stages or {}):
+        for stage, seconds in stages_of_path.items():
+            if seconds is not None:
+                stages_of_path[stage] = round(max(seconds, 0), 3)
+    return {
+        'tiles': len(server.tiles[product]),
+        'bytes': bytes_sent,
+        'download_MBps': (round(bytes_sent / (1024. * 1024) / stages['download'], 2)
+                          if stages['download'] else None),
+        'stages': stages,
+        'zip_stages': zip_stages,
+        'profile': {'stages': profile['stages'],
+                    'module_totals': profile['module_totals']},
+        'runs': dict((name, [round(seconds, 3) for seconds in times])
+                     for name, times in runs.items()),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark r.in.usgs against a mock of the TNM API")
+    parser.add_argument('--products', default='ned,nlcd,naip')
+    parser.add_argument('--tiles', type=int, default=16, help="tiles per product")
+    parser.add_argument('--tile-size', type=int, default=512, help="tile width in cells")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per request")
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help="MB/s per connection, 0 for unlimited")
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--nprocs', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', help="JSON file with results (default stdout)")
+    args = parser.parse_args()
+
+    if not gscript.locn_is_latlong():
+        gscript.fatal("Run the benchmark in a location with geographic coordinates")
+    products = args.products.split(',')
+    for product in products:
+        if product not in PRODUCTS:
+            gscript.fatal("Unknown product <{0}>".format(product))
+
+    scratch = tempfile.mkdtemp(prefix='r_in_usgs_benchmark_')
+    mapset_path, env = create_mapset('r_in_usgs_benchmark_{0}'.format(os.getpid()))
+    log = open(os.path.join(scratch, 'benchmark.log'), 'w')
+    server = None
+    try:
+        gscript.message("Creating synthetic tiles...")
+        server = MockTNM(products, args.tiles, args.tile_size,
+                         latency=args.latency,
+                         bandwidth=int(args.bandwidth * 1024 * 1024),
+                         directory=os.path.join(scratch, 'tiles'))
+        server.start()
+        env['R_IN_USGS_TNM_URL'] = server.api_url
+        results = {}
+        for product in products:
+            gscript.message("Benchmarking {0}...".format(product))
+            results[product] = benchmark_product(
+                product, server, env, scratch, log, args.repeat,
+                {'tile_size': args.tile_size,
+                 'download_workers': args.download_workers,
+                 'nprocs': args.nprocs})
+    finally:
+        log.close()
+        if server:
+            server.stop()
+        shutil.rmtree(mapset_path)
+    shutil.rmtree(scratch)
+
+    report = {
+        'module_version': module_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'tiles': args.tiles,
+            'tile_size': args.tile_size,
+            'latency': args.latency,
+            'bandwidth_MBps': args.bandwidth,
+            'download_workers': args.download_workers,
+            'nprocs': args.nprocs,
+            'repeat': args.repeat,
+            },
+        'results': results,
+        }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
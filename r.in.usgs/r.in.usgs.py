@@ -34,6 +34,7 @@
 #%option
 #% key: product
 #% required: yes
+#% multiple: yes
 #% options: ned,nlcd,naip
 #% label: USGS data product
 #% description: Available USGS data products to query
@@ -50,14 +51,38 @@
 #% description: Directory for USGS data download and processing
 #%end
 
+#%option G_OPT_V_INPUT
+#% key: mask
+#% required: no
+#% label: Vector map with areas of interest
+#% description: Only tiles intersecting the areas are downloaded
+#%end
+
+#%option G_OPT_V_INPUT
+#% key: aoi
+#% required: no
+#% label: Vector map with areas of interest for batch processing
+#% description: One output named output_name_category is created for each category of areas
+#% guisection: Batch
+#%end
+
+#%option G_OPT_F_INPUT
+#% key: aoi_file
+#% required: no
+#% label: File with areas of interest for batch processing
+#% description: Lines name,north,south,east,west; one output named output_name_name is created for each line
+#% guisection: Batch
+#%end
+
 #%option
 #% key: ned_dataset
 #% required: no
-#% options: ned1sec, ned13sec, ned19sec
+#% multiple: yes
+#% options: ned1sec, ned13sec, ned19sec, auto
 #% answer: ned1sec
 #% label: NED dataset
 #% description: Available NED datasets to query
-#% descriptions: ned1sec;NED 1 arc-second;ned13sec;NED 1/3 arc-second;ned19sec;NED 1/9 arc-second
+#% descriptions: ned1sec;NED 1 arc-second;ned13sec;NED 1/3 arc-second;ned19sec;NED 1/9 arc-second;auto;Coarsest NED dataset meeting resolution of the computational region
 #% guisection: NED
 #%end
 
@@ -75,6 +100,7 @@
 #%option
 #% key: nlcd_subset
 #% required: no
+#% multiple: yes
 #% options: landcover, impervious, canopy
 #% answer: landcover
 #% label: NLCD subset
@@ -83,6 +109,17 @@
 #% guisection: NLCD
 #%end
 
+#%option
+#% key: naip_composite
+#% type: string
+#% required: no
+#% options: rgb,group,none
+#% answer: rgb
+#% label: Output created from NAIP bands
+#% descriptions: rgb;RGB composite raster;group;Imagery group of the bands;none;Only the individual bands
+#% guisection: NAIP
+#%end
+
 #%option
 #% key: resampling_method
 #% type: string
@@ -94,13 +131,149 @@
 #% answer: default
 #%end
 
+#%option
+#% key: max_scratch_space
+#% type: integer
+#% required: no
+#% answer: 0
+#% label: Maximum disk space for downloaded and extracted files in MB
+#% description: Files are removed right after import and downloads wait when the limit is reached, 0 for unlimited
+#%end
+
+#%option
+#% key: download_workers
+#% type: integer
+#% required: no
+#% answer: 4
+#% label: Number of parallel downloads
+#% description: Number of tiles downloaded concurrently
+#%end
+
+#%option G_OPT_M_DIR
+#% key: cache_directory
+#% required: no
+#% label: Shared cache directory for downloaded USGS files
+#% description: Downloaded files are shared through this directory by all users and processes
+#% guisection: Cache
+#%end
+
+#%option
+#% key: cache_size
+#% type: integer
+#% required: no
+#% answer: 0
+#% label: Maximum size of the shared cache in MB
+#% description: Least recently used files are removed when the cache grows above this size, 0 means no limit
+#% guisection: Cache
+#%end
+
+#%option
+#% key: retries
+#% type: integer
+#% required: no
+#% answer: 5
+#% label: Number of download retries
+#% description: Failed downloads are retried with increasing delay
+#%end
+
+#%option
+#% key: retry_time
+#% type: integer
+#% required: no
+#% answer: 600
+#% label: Maximum time in seconds to wait for retries of one download
+#%end
+
+#%option G_OPT_M_NPROCS
+#% description: Number of tiles imported in parallel, each in a temporary mapset
+#%end
+
+#%option
+#% key: query_cache_ttl
+#% type: integer
+#% required: no
+#% answer: 24
+#% label: Lifetime of cached TNM API query results in hours
+#% description: Query results are cached in the output directory, 0 disables the cache
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: profile
+#% required: no
+#% label: Name for output JSON file with timings of stages, tiles and modules
+#% description: Wall and CPU time, bytes and throughput for profiling of the run
+#% guisection: Profiling
+#%end
+
 #%flag
 #% key: k
 #% description: Keep extracted files after GRASS import and patch
 #%end
 
+#%flag
+#% key: e
+#% label: Extract files from ZIP archives before import
+#% description: By default, files are imported directly from the archives
+#%end
+
+#%flag
+#% key: m
+#% label: Import all tiles as a single mosaic
+#% description: Tiles are combined into a GDAL VRT which is imported once instead of importing and patching each tile (requires GDAL Python bindings)
+#%end
+
+#%flag
+#% key: c
+#% label: Use only cached TNM API query results and local files (offline mode)
+#% description: Cached results are used regardless of their age, nothing is downloaded
+#%end
+
+#%flag
+#% key: r
+#% label: Keep imported tiles and reuse them in later runs
+#% description: Tiles are imported in full extent and tagged with their source, matching tiles are not imported again
+#%end
+
+#%flag
+#% key: a
+#% label: Add tiles in newly covered area to existing output
+#% description: Only tiles not covered by the existing output raster are downloaded, imported and patched to it
+#%end
+
+#%flag
+#% key: l
+#% label: Link tiles instead of importing them
+#% description: Tiles or a GDAL VRT mosaic of them are registered with r.external and read in place, source files are kept
+#%end
+
+#%flag
+#% key: w
+#% label: Reproject linked tiles on the fly
+#% description: Tiles are linked through a GDAL warped VRT in the coordinate reference system of the location (requires GDAL Python bindings)
+#%end
+
+#%flag
+#% key: p
+#% label: Write also Python profiler statistics
+#% description: Statistics of all threads are written next to the profile file with extension .prof
+#% guisection: Profiling
+#%end
+
 #%rules
 #% required: output_name, -i
+#% exclusive: -m, -r
+#% exclusive: -m, -a
+#% exclusive: -m, max_scratch_space
+#% exclusive: -k, max_scratch_space
+#% exclusive: -a, aoi, aoi_file
+#% exclusive: -m, aoi, aoi_file
+#% exclusive: -l, -m
+#% exclusive: -l, -r
+#% exclusive: -l, -a
+#% exclusive: -l, max_scratch_space
+#% exclusive: -l, aoi, aoi_file
+#% requires: -w, -l
+#% requires: -p, profile
 #%end
 
 import sys
@@ -108,77 +281,1972 @@ import os
 import zipfile
 import grass.script as gscript
 import urllib
+import base64
 import urllib2
+import urlparse
+import httplib
+import socket
+import threading
+import Queue
 import json
+import copy
+import random
+import re
+import shutil
+import sqlite3
+import hashlib
+import math
+import time
+import zlib
+import multiprocessing
 import atexit
+import errno
+import contextlib
+import cProfile
+import pstats
 
 from grass.exceptions import CalledModuleError
 
+try:
+    import fcntl
+except ImportError:
+    # file locking is not available on MS Windows
+    fcntl = None
+
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    gdal = None
+
 cleanup_list = []
+cleanup_caches = []
+cleanup_dirs = []
 
+# keep-alive connections, one set per download thread
+_http_local = threading.local()
 
-def main():
-    # Hard-coded parameters needed for USGS datasets
-    usgs_product_dict = {
-        "ned": {
-                'product': 'National Elevation Dataset (NED)',
-                'dataset': {
-                        'ned1sec': (1. / 3600, 30, 100),
-                        'ned13sec': (1. / 3600 / 3, 10, 30),
-                        'ned19sec': (1. / 3600 / 9, 3, 10)
-                        },
-                'subset': {},
-                'extent': [
-                        '1 x 1 degree',
-                        '15 x 15 minute'
-                         ],
-                'format': 'IMG',
-                'extension': 'img',
-                'zip': True,
-                'srs': 'wgs84',
-                'srs_proj4': "+proj=longlat +ellps=GRS80 +datum=NAD83 +nodefs",
-                'interpolation': 'bilinear',
-                'url_split': '/'
-                },
-        "nlcd": {
-                'product': 'National Land Cover Database (NLCD)',
-                'dataset': {
-                        'National Land Cover Database (NLCD) - 2001': (1. / 3600, 30, 100),
-                        'National Land Cover Database (NLCD) - 2006': (1. / 3600, 30, 100),
-                        'National Land Cover Database (NLCD) - 2011': (1. / 3600, 30, 100)
-                        },
-                'subset': {
-                        'Percent Developed Imperviousness',
-                        'Percent Tree Canopy',
-                        'Land Cover'
-                        },
-                'extent': ['3 x 3 degree'],
-                'format': 'GeoTIFF',
-                'extension': 'tif',
-                'zip': True,
-                'srs': 'wgs84',
-                'srs_proj4': "+proj=longlat +ellps=GRS80 +datum=NAD83 +nodefs",
-                'interpolation': 'nearest',
-                'url_split': '/'
-                },
-        "naip": {
-                'product': 'USDA National Agriculture Imagery Program (NAIP)',
-                'dataset': {
-                        'Imagery - 1 meter (NAIP)': (1. / 3600 / 27, 1, 3)},
-                'subset': {},
-                'extent': [
-                        '3.75 x 3.75 minute',
-                         ],
-                'format': 'JPEG2000',
-                'extension': 'jp2',
-                'zip': False,
-                'srs': 'wgs84',
-                'srs_proj4': "+proj=longlat +ellps=GRS80 +datum=NAD83 +nodefs",
-                'interpolation': 'nearest',
-                'url_split': '/'
-                }
+# results of TNM API queries of this run
+_query_results = {}
+_query_results_lock = threading.Lock()
+
+
+def http_proxy(scheme, host):
+    """Return parts of proxy URL for scheme and host or None
+
+    Proxies are configured as for urllib2, by http_proxy, https_proxy
+    and no_proxy environment variables (or system settings).
+    """
+    proxy = urllib.getproxies().get(scheme)
+    if not proxy or urllib.proxy_bypass(host):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urlparse.urlsplit(proxy)
+
+
+def http_connection(parts, timeout):
+    """Return connection to host of URL parts and proxy headers
+
+    Requests of plain HTTP are sent to the proxy with the whole URL
+    (proxy headers are not None), HTTPS goes through a tunnel
+    opened by the proxy.
+    """
+    if parts.scheme == 'https':
+        connection_class = httplib.HTTPSConnection
+    else:
+        connection_class = httplib.HTTPConnection
+    proxy = http_proxy(parts.scheme, parts.netloc)
+    if not proxy:
+        return connection_class(parts.netloc, timeout=timeout), None
+    proxy_headers = {}
+    if proxy.username:
+        credentials = '{0}:{1}'.format(urllib.unquote(proxy.username),
+                                       urllib.unquote(proxy.password or ''))
+        proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+    conn = connection_class(proxy.hostname, proxy.port or 80, timeout=timeout)
+    if parts.scheme == 'https':
+        conn.set_tunnel(parts.hostname, parts.port, proxy_headers)
+        return conn, None
+    return conn, proxy_headers
+
+
+def http_get(url, headers=None, timeout=12, max_redirects=5):
+    """Send GET request reusing a keep-alive connection to the host
+
+    Connections are kept per thread and per host, so consecutive
+    requests to the same server skip TCP and TLS handshakes.
+    Proxy configured by environment variables is used.
+    Redirects are followed. The returned response must be read
+    completely before the thread sends another request.
+    """
+    if not hasattr(_http_local, 'connections'):
+        _http_local.connections = {}
+    connections = _http_local.connections
+    request_headers = {'Connection': 'keep-alive'}
+    if headers:
+        request_headers.update(headers)
+    for redirect in range(max_redirects + 1):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        response = None
+        # a reused connection may have been closed by the server,
+        # in that case try once more with a new connection
+        for attempt in range(2):
+            if key in connections:
+                conn, proxy_headers = connections[key]
+                reused = True
+            else:
+                conn, proxy_headers = http_connection(parts, timeout)
+                connections[key] = conn, proxy_headers
+                reused = False
+            try:
+                if proxy_headers is None:
+                    conn.request('GET', path, headers=request_headers)
+                else:
+                    conn.request('GET', urlparse.urlunsplit(parts),
+                                 headers=dict(request_headers, **proxy_headers))
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as error:
+                conn.close()
+                del connections[key]
+                if not reused:
+                    raise urllib2.URLError(error)
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader('location')
+            response.read()
+            url = urlparse.urljoin(url, location)
+            continue
+        if response.status >= 400:
+            response.read()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        return response
+    raise urllib2.URLError("Too many redirects: {0}".format(url))
+
+
+def close_connections():
+    """Close keep-alive connections of the current thread
+
+    Used when a response could not be read completely
+    and its connection cannot be reused.
+    """
+    connections = getattr(_http_local, 'connections', {})
+    for conn, proxy_headers in connections.values():
+        conn.close()
+    connections.clear()
+
+
+def content_range_total(header):
+    """Return total size from Content-Range header or None if unknown"""
+    # format is 'bytes start-end/total' or 'bytes */total'
+    try:
+        return int(header.rsplit('/', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def get_location_srs():
+    """Return spatial reference of current location as OSR object
+
+    Returns None when GDAL Python bindings are not available
+    or the location has no projection information.
+    """
+    if not gdal:
+        return None
+    try:
+        wkt = gscript.read_command('g.proj', flags='wf', quiet=True)
+    except CalledModuleError:
+        return None
+    srs = osr.SpatialReference()
+    if not wkt.strip() or srs.ImportFromWkt(wkt) != 0:
+        return None
+    return srs
+
+
+def region_boundary_points(region, density=16):
+    """Return points along the boundary of the region
+
+    Each edge is split into density segments, so that the boundary
+    keeps its shape after reprojection.
+    """
+    north, south = float(region['n']), float(region['s'])
+    east, west = float(region['e']), float(region['w'])
+    points = []
+    for i in range(density):
+        step = float(i) / density
+        points.append((west + step * (east - west), south))
+    for i in range(density):
+        step = float(i) / density
+        points.append((east, south + step * (north - south)))
+    for i in range(density):
+        step = float(i) / density
+        points.append((east - step * (east - west), north))
+    for i in range(density):
+        step = float(i) / density
+        points.append((west, north - step * (north - south)))
+    return points
+
+
+def extent_difference(region, extents):
+    """Return rectangles covering the part of region outside of extents
+
+    Each extent is cut out of the rectangles remaining from the previous
+    extents, so the rectangles do not overlap.
+    """
+    rectangles = [region]
+    for extent in extents:
+        rectangles = [rectangle for remaining in rectangles
+                      for rectangle in rectangle_difference(remaining, extent)]
+    return rectangles
+
+
+def rectangle_difference(region, extent):
+    """Return rectangles covering the part of region outside of extent
+
+    Rectangles do not overlap: strips north and south of the extent
+    span the whole region, strips west and east of it span only
+    the latitudes shared with the extent.
+    """
+    north, south = float(region['n']), float(region['s'])
+    east, west = float(region['e']), float(region['w'])
+    ext_north, ext_south = float(extent['n']), float(extent['s'])
+    ext_east, ext_west = float(extent['e']), float(extent['w'])
+    if ext_south >= north or ext_north <= south or ext_west >= east or ext_east <= west:
+        return [{'n': north, 's': south, 'e': east, 'w': west}]
+    rectangles = []
+    if north > ext_north:
+        rectangles.append({'n': north, 's': ext_north, 'e': east, 'w': west})
+    if south < ext_south:
+        rectangles.append({'n': ext_south, 's': south, 'e': east, 'w': west})
+    middle_north, middle_south = min(north, ext_north), max(south, ext_south)
+    if west < ext_west:
+        rectangles.append({'n': middle_north, 's': middle_south, 'e': ext_west, 'w': west})
+    if east > ext_east:
+        rectangles.append({'n': middle_north, 's': middle_south, 'e': east, 'w': ext_east})
+    return rectangles
+
+
+def virtual_raster_inputs(name):
+    """Return inputs of virtual raster created by r.buildvrt
+
+    Returns None when the raster in the current mapset is not virtual.
+    """
+    gisenv = gscript.gisenv()
+    vrt_file = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'],
+                            gisenv['MAPSET'], 'cell_misc', name, 'vrt')
+    if not os.path.exists(vrt_file):
+        return None
+    with open(vrt_file) as vrt:
+        return [line.strip().split('@')[0] for line in vrt if line.strip()]
+
+
+def raster_extents(name):
+    """Return extents of raster or of the inputs of virtual raster
+
+    Virtual raster created from parts does not have data in all of its
+    bounding box, so the extents of the parts are returned.
+    """
+    extents = []
+    for part in virtual_raster_inputs(name) or [name]:
+        info = gscript.raster_info(part)
+        extents.append({'n': info['north'], 's': info['south'],
+                        'e': info['east'], 'w': info['west']})
+    return extents
+
+
+def transform_points(points, proj_out, location_srs=None):
+    """Transform points from current location to proj_out (PROJ.4 string)
+
+    Points are transformed in-process when spatial reference
+    of the location is given, otherwise with a single m.proj call.
+    """
+    if location_srs:
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromProj4(proj_out)
+        # keep x, y order (longitude, latitude) with GDAL 3
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            location_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(location_srs, target_srs)
+        return [transform.TransformPoint(x, y)[:2] for x, y in points]
+
+    # separator applies to both input and output of m.proj
+    coordinates = '\n'.join('{0},{1}'.format(x, y) for x, y in points)
+    start = time.time()
+    proc = gscript.pipe_command('m.proj', input='-', proj_out=proj_out,
+                                separator='comma', flags='d',
+                                stdin=gscript.PIPE)
+    output = profile.communicate('m.proj', proc, start, coordinates)
+    if proc.returncode != 0:
+        gscript.fatal(_("Unable to reproject computational region"))
+    transformed = []
+    for line in output.splitlines():
+        if line.strip():
+            x, y = line.split(',')[:2]
+            transformed.append((float(x), float(y)))
+    return transformed
+
+
+def points_bbox(points):
+    """Return bbox (west, south, east, north) of points"""
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def point_in_polygon(x, y, polygon):
+    """Check if point is inside polygon given by list of vertices"""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        xi, yi = polygon[i]
+        xj, yj = polygon[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def bbox_intersection(first, second):
+    """Return intersection of two bboxes (west, south, east, north) or None"""
+    west = max(first[0], second[0])
+    south = max(first[1], second[1])
+    east = min(first[2], second[2])
+    north = min(first[3], second[3])
+    if west >= east or south >= north:
+        return None
+    return [west, south, east, north]
+
+
+def shrink_bbox(bbox, tolerance=1e-6):
+    """Return bbox (west, south, east, north) shrunk by tolerance
+
+    Shrunk bbox does not intersect polygons it only touches.
+    """
+    west, south, east, north = bbox
+    return [west + tolerance, south + tolerance, east - tolerance, north - tolerance]
+
+
+def segment_intersects_bbox(start, end, bbox):
+    """Check if line segment intersects bbox (west, south, east, north)
+
+    Uses Liang-Barsky clipping of the segment by the bbox.
+    """
+    west, south, east, north = bbox
+    x, y = start
+    dx, dy = end[0] - x, end[1] - y
+    t_start, t_end = 0.0, 1.0
+    for p, q in ((-dx, x - west), (dx, east - x), (-dy, y - south), (dy, north - y)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = float(q) / p
+        if p < 0:
+            if t > t_end:
+                return False
+            t_start = max(t_start, t)
+        else:
+            if t < t_start:
+                return False
+            t_end = min(t_end, t)
+    return True
+
+
+def polygon_contains_point(x, y, polygon):
+    """Check if point is inside polygon (list of rings) and not in its holes"""
+    inside = False
+    for ring in polygon:
+        if point_in_polygon(x, y, ring):
+            inside = not inside
+    return inside
+
+
+class PolygonIndex(object):
+    """Polygons with grid index of their edges
+
+    Polygons are lists of rings (outer boundary and holes), each ring
+    is a list of vertices. The edges are stored in cells of a regular
+    grid, so that intersection of a bbox with the polygons is tested
+    only against the edges near the bbox.
+    """
+    def __init__(self, polygons, size=32):
+        self.polygons = polygons
+        points = [point for polygon in polygons for ring in polygon for point in ring]
+        self.bbox = [float(coord) for coord in points_bbox(points)]
+        west, south, east, north = self.bbox
+        self.size = size
+        self.cell_width = (east - west) / size or 1.
+        self.cell_height = (north - south) / size or 1.
+        self.cells = {}
+        for polygon in polygons:
+            for ring in polygon:
+                for i in range(len(ring)):
+                    edge = (ring[i - 1], ring[i])
+                    for cell in self._cells(points_bbox(edge)):
+                        self.cells.setdefault(cell, []).append(edge)
+
+    def _cells(self, bbox):
+        west, south, east, north = self.bbox
+        min_col = max(0, int((bbox[0] - west) / self.cell_width))
+        max_col = min(self.size - 1, int((bbox[2] - west) / self.cell_width))
+        min_row = max(0, int((bbox[1] - south) / self.cell_height))
+        max_row = min(self.size - 1, int((bbox[3] - south) / self.cell_height))
+        for col in range(min_col, max_col + 1):
+            for row in range(min_row, max_row + 1):
+                yield col, row
+
+    def contains_point(self, x, y):
+        """Check if point is inside any of the polygons"""
+        return any(polygon_contains_point(x, y, polygon) for polygon in self.polygons)
+
+    def intersects(self, bbox):
+        """Check if bbox (west, south, east, north) intersects the polygons"""
+        if not bbox_intersection(bbox, self.bbox):
+            return False
+        for cell in self._cells(bbox):
+            for start, end in self.cells.get(cell, ()):
+                if segment_intersects_bbox(start, end, bbox):
+                    return True
+        # no edge crosses the bbox, so it is completely inside or outside
+        return self.contains_point((bbox[0] + bbox[2]) / 2., (bbox[1] + bbox[3]) / 2.)
+
+
+def vector_area_polygons(vector):
+    """Return areas of vector map as polygons (lists of rings)"""
+    wkt = gscript.read_command('v.out.ascii', input=vector, type='area',
+                               format='wkt')
+    polygons = []
+    for line in wkt.splitlines():
+        rings = []
+        for ring in re.findall(r'\(([^()]+)\)', line):
+            rings.append([tuple(float(coord) for coord in vertex.split()[:2])
+                          for vertex in ring.split(',')])
+        if rings:
+            polygons.append(rings)
+    return polygons
+
+
+def transform_polygons(polygons, proj_out, location_srs=None):
+    """Transform polygons (lists of rings) from current location to proj_out
+
+    All vertices are transformed at once.
+    """
+    points = transform_points([point for polygon in polygons
+                               for ring in polygon for point in ring],
+                              proj_out, location_srs)
+    points = iter(points)
+    return [[[next(points) for point in ring] for ring in polygon]
+            for polygon in polygons]
+
+
+def read_aoi_file(path):
+    """Read areas of interest from file with lines name,north,south,east,west
+
+    Returns list of dictionaries with name, region and polygons.
+    Empty lines and lines starting with # are ignored.
+    """
+    aois = []
+    with open(path) as aoi_file:
+        for number, line in enumerate(aoi_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                name, north, south, east, west = [item.strip() for item in line.split(',')]
+                region = {'n': float(north), 's': float(south),
+                          'e': float(east), 'w': float(west)}
+            except ValueError:
+                gscript.fatal(_("Invalid area of interest on line {0} of file <{1}>").format(
+                    number, path))
+            aois.append({'name': name, 'region': region, 'cat': None,
+                         'polygons': [[region_boundary_points(region)]]})
+    return aois
+
+
+def read_aoi_vector(vector):
+    """Read areas of interest from areas of vector map, one per category
+
+    All areas and centroids are read at once, each area gets
+    the category of the centroid inside it.
+    Returns list of dictionaries with name, region, category and polygons.
+    """
+    areas = [(points_bbox(polygon[0]), polygon) for polygon in vector_area_polygons(vector)]
+    output = gscript.read_command('v.out.ascii', input=vector, type='centroid',
+                                  format='point', separator='pipe')
+    polygons_by_cat = {}
+    for line in output.splitlines():
+        values = line.split('|')
+        if len(values) < 3 or not values[-1].strip():
+            continue
+        x, y, cat = float(values[0]), float(values[1]), int(values[-1])
+        for bbox, polygon in areas:
+            if (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3] and
+                    polygon_contains_point(x, y, polygon)):
+                polygons_by_cat.setdefault(cat, []).append(polygon)
+                break
+    aois = []
+    for cat, polygons in sorted(polygons_by_cat.items()):
+        west, south, east, north = points_bbox([point for polygon in polygons
+                                                for ring in polygon for point in ring])
+        aois.append({'name': str(cat), 'cat': cat, 'polygons': polygons,
+                     'region': {'n': north, 's': south, 'e': east, 'w': west}})
+    return aois
+
+
+def normalize_bbox(bbox):
+    """Round bbox (west, south, east, north) outwards to 6 decimal places
+
+    Nearly identical regions then give identical TNM API queries
+    and share the cached query results.
+    """
+    scale = 1e6
+    west, south, east, north = [float(coord) for coord in bbox]
+    return [math.floor(west * scale) / scale, math.floor(south * scale) / scale,
+            math.ceil(east * scale) / scale, math.ceil(north * scale) / scale]
+
+
+def query_cache_path(cache_dir, base_url, query):
+    """Return path to cache file of TNM API query given as list of pairs
+
+    Results of the same query sent to another server (a mirror
+    or a mock of the API) are cached separately.
+    """
+    key = hashlib.sha1(json.dumps([base_url, sorted(query)])).hexdigest()
+    return os.path.join(cache_dir, key + '.json')
+
+
+def query_tnm(base_url, query, cache_dir, ttl, offline=False):
+    """Return parsed JSON response of TNM API query
+
+    Query is a list of (parameter, value) pairs. Successful responses
+    are cached in cache_dir and reused for ttl seconds.
+    When offline is True, cached response is used regardless of its age.
+    Returns None when the query fails or, in offline mode,
+    when there is no cached response. Products sharing a query
+    (subsets of NLCD) run it only once, also when run concurrently.
+    """
+    cache_file = query_cache_path(cache_dir, base_url, query)
+    with _query_results_lock:
+        entry = _query_results.setdefault((base_url, cache_file),
+                                          {'lock': threading.Lock()})
+    with entry['lock']:
+        if 'result' not in entry:
+            entry['result'] = _query_tnm(base_url, query, cache_file, ttl, offline)
+        return entry['result']
+
+
+def _query_tnm(base_url, query, cache_file, ttl, offline):
+    cache_dir = os.path.dirname(cache_file)
+    if os.path.exists(cache_file):
+        age = time.time() - os.path.getmtime(cache_file)
+        if offline or age < ttl:
+            try:
+                with open(cache_file) as cached:
+                    gscript.verbose(_("Using cached TNM API query results from {0}").format(cache_file))
+                    return json.load(cached)
+            except ValueError:
+                # corrupted cache file, query the API again
+                os.remove(cache_file)
+    if offline:
+        return None
+
+    TNM_API_URL = base_url + urllib.urlencode(query)
+    gscript.verbose("TNM API Query URL:\t{0}".format(TNM_API_URL))
+    try:
+        TNM_API_GET = http_get(TNM_API_URL)
+        return_JSON = json.load(TNM_API_GET)
+    except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError):
+        close_connections()
+        return None
+
+    if ttl > 0 and not return_JSON.get('errors'):
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # created by query of another product in the meantime
+                if not os.path.isdir(cache_dir):
+                    raise
+        # write to temporary file first, so that concurrent runs
+        # never read incomplete cache file
+        tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as cached:
+            json.dump(return_JSON, cached)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        os.rename(tmp_file, cache_file)
+    return return_JSON
+
+
+def queue_get(queue):
+    """Get item from queue, blocking but responsive to Ctrl+C"""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Queue.Empty:
+            pass
+
+
+def iter_tnm_items(first_page, base_url, query, cache_dir, ttl, offline,
+                   workers, page_size):
+    """Yield items from all pages of TNM API query results
+
+    Items of the first (already parsed) page are yielded right away.
+    Remaining pages are requested concurrently using the offset and max
+    parameters and their items are yielded as the pages arrive,
+    so only a few pages are kept in memory at once.
+    """
+    for item in first_page['items']:
+        yield item
+    total = int(first_page['total'])
+    # the API may return less items than requested per page
+    if 0 < len(first_page['items']) < page_size:
+        page_size = len(first_page['items'])
+    offsets = range(page_size, total, page_size)
+    if not offsets:
+        return
+
+    todo = Queue.Queue()
+    for offset in offsets:
+        todo.put(offset)
+    # bounded, so that workers do not get too far ahead of processing
+    pages = Queue.Queue(maxsize=2 * workers)
+
+    def worker():
+        while True:
+            try:
+                offset = todo.get_nowait()
+            except Queue.Empty:
+                return
+            page_query = query + [('offset', str(offset)), ('max', str(page_size))]
+            try:
+                page = query_tnm(base_url, page_query, cache_dir, ttl, offline)
+            except Exception as error:
+                # e.g. cache not writable, the error is reported
+                # by the consumer which would wait for the page forever
+                page = error
+            pages.put((offset, page))
+
+    for i in range(max(1, min(workers, len(offsets)))):
+        thread = threading.Thread(target=profile.thread_target(worker))
+        thread.daemon = True
+        thread.start()
+    for i in range(len(offsets)):
+        offset, page = queue_get(pages)
+        if isinstance(page, Exception):
+            gscript.fatal(_("Unable to load USGS TNM API results starting at item {0}: {1}").format(
+                offset, page))
+        if page is None:
+            gscript.fatal(_("Unable to load USGS TNM API results starting at item {0}.").format(offset))
+        if page.get('errors'):
+            gscript.fatal("TNM API Error - {0}".format(str(page['errors'])))
+        for item in page['items']:
+            yield item
+
+
+def find_zip_member(zip_path, extension):
+    """Return name of the first member of ZIP archive with given extension"""
+    with zipfile.ZipFile(zip_path, "r") as read_zip:
+        for member in read_zip.namelist():
+            if member.endswith(extension):
+                return str(member)
+    return None
+
+
+def vsizip_path(zip_path, member):
+    """Return GDAL virtual file system path to a file inside ZIP archive"""
+    return '/vsizip/{0}/{1}'.format(os.path.abspath(zip_path), member)
+
+
+def file_crc32(path):
+    """Compute CRC-32 of file as stored in ZIP archives"""
+    crc = 0
+    with open(path, 'rb') as local_file:
+        for block in iter(lambda: local_file.read(1024 * 1024), b''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
+
+
+def extract_zip_member(zip_path, member, work_dir):
+    """Extract member of ZIP archive into work_dir, return its path
+
+    A file extracted previously is kept when its size and CRC-32
+    match the member, otherwise it is extracted again.
+    """
+    extracted_tile = os.path.join(work_dir, member)
+    with zipfile.ZipFile(zip_path, "r") as read_zip:
+        info = read_zip.getinfo(member)
+        if os.path.exists(extracted_tile):
+            if (os.path.getsize(extracted_tile) == info.file_size and
+                    file_crc32(extracted_tile) == info.CRC):
+                return extracted_tile
+            os.remove(extracted_tile)
+        read_zip.extract(info, work_dir)
+    return extracted_tile
+
+
+def build_vrt(vrt_path, tiles):
+    """Build GDAL VRT mosaic of tiles
+
+    Returns False without creating the VRT when the tiles cannot be
+    mosaicked because they differ in coordinate reference system
+    or number of bands (NAIP tiles from different UTM zones).
+    """
+    first_srs = None
+    first_band_count = None
+    for tile in tiles:
+        dataset = gdal.Open(tile)
+        if dataset is None:
+            return False
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(dataset.GetProjectionRef())
+        if first_srs is None:
+            first_srs = srs
+            first_band_count = dataset.RasterCount
+        elif not srs.IsSame(first_srs) or dataset.RasterCount != first_band_count:
+            return False
+        dataset = None
+    vrt = gdal.BuildVRT(vrt_path, tiles, resolution='highest')
+    if vrt is None:
+        return False
+    # closing the dataset writes the file
+    vrt = None
+    return True
+
+
+def gdal_resampling(method):
+    """Return GDAL name of r.import resampling method"""
+    return {'nearest': 'near', 'bicubic': 'cubic'}.get(method, method)
+
+
+def build_warped_vrt(vrt_path, tiles, srs, bounds, resolution, resampling):
+    """Build GDAL warped VRT of tiles reprojected to given SRS
+
+    Tiles are grouped by coordinate reference system, each group
+    is mosaicked and warped separately, because a warped VRT has
+    one source, and the warped groups are mosaicked together.
+    Bounds are west, south, east, north in the target SRS.
+    Returns False when the tiles cannot be read by GDAL.
+    """
+    groups = []
+    for tile in tiles:
+        dataset = gdal.Open(tile)
+        if dataset is None:
+            return False
+        tile_srs = osr.SpatialReference()
+        tile_srs.ImportFromWkt(dataset.GetProjectionRef())
+        dataset = None
+        for group_srs, group_tiles in groups:
+            if tile_srs.IsSame(group_srs):
+                group_tiles.append(tile)
+                break
+        else:
+            groups.append((tile_srs, [tile]))
+    base_path = os.path.splitext(vrt_path)[0]
+    warped = []
+    for i, (group_srs, group_tiles) in enumerate(groups):
+        source = group_tiles[0]
+        if len(group_tiles) > 1:
+            source = '{0}_{1}.vrt'.format(base_path, i)
+            if not build_vrt(source, group_tiles):
+                return False
+        warped_path = vrt_path if len(groups) == 1 else '{0}_{1}_warped.vrt'.format(base_path, i)
+        options = {'format': 'VRT', 'dstSRS': srs.ExportToWkt(),
+                   'outputBounds': bounds, 'resampleAlg': resampling}
+        if resolution:
+            options.update(xRes=resolution, yRes=resolution)
+        vrt = gdal.Warp(warped_path, source, **options)
+        if vrt is None:
+            return False
+        vrt = None
+        warped.append(warped_path)
+    if len(warped) > 1:
+        vrt = gdal.BuildVRT(vrt_path, warped)
+        if vrt is None:
+            return False
+        vrt = None
+    return True
+
+
+def create_temp_mapset(mapset):
+    """Create temporary mapset for a parallel worker in current location
+
+    The mapset gets the current computational region (including
+    temporary region) and it is removed at exit. Returns environment
+    for running modules in the mapset.
+    """
+    gisenv = gscript.gisenv()
+    location_path = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'])
+    mapset_path = os.path.join(location_path, mapset)
+    os.mkdir(mapset_path)
+    cleanup_dirs.append(mapset_path)
+    if os.environ.get('WIND_OVERRIDE'):
+        region_path = os.path.join(location_path, gisenv['MAPSET'], 'windows',
+                                   os.environ['WIND_OVERRIDE'])
+    else:
+        region_path = os.path.join(location_path, gisenv['MAPSET'], 'WIND')
+    shutil.copy(region_path, os.path.join(mapset_path, 'WIND'))
+    gisrc = gscript.tempfile()
+    with open(gisrc, 'w') as f:
+        f.write("GISDBASE: {0}\n".format(gisenv['GISDBASE']))
+        f.write("LOCATION_NAME: {0}\n".format(gisenv['LOCATION_NAME']))
+        f.write("MAPSET: {0}\n".format(mapset))
+    env = os.environ.copy()
+    env['GISRC'] = gisrc
+    return env
+
+
+def band_name(name, band):
+    """Return name of raster band for raster name with optional mapset"""
+    if '@' in name:
+        name, mapset = name.split('@')
+        return '{0}.{1}@{2}'.format(name, band, mapset)
+    return '{0}.{1}'.format(name, band)
+
+
+def tile_source_tag(url, size, resolution, resampling):
+    """Return tag identifying source and import parameters of a tile
+
+    The tag is stored as raster metadata (source2), so it must fit
+    into a history record; URL and size are represented by a hash.
+    """
+    key = hashlib.sha1('{0}:{1}'.format(url, size)).hexdigest()[:16]
+    return "res={0} resample={1} key={2}".format(resolution, resampling, key)
+
+
+def tile_raster_matches(name, tag):
+    """Check that raster exists in the current mapset with given tag"""
+    if not gscript.find_file(name, element='cell', mapset='.')['file']:
+        return False
+    info = gscript.parse_command('r.info', map=name, flags='e')
+    return info.get('source2', '').strip('"') == tag
+
+
+def linked_raster_reads(mapset_path, raster, path):
+    """Check that raster linked by r.external reads file at path
+
+    The file can be linked directly, inside a ZIP archive or through
+    (nested) GDAL VRT files. Returns False when the raster does not exist.
+    """
+    link_file = os.path.join(mapset_path, 'cell_misc', raster, 'gdal')
+    try:
+        with open(link_file) as link:
+            sources = [line.split(':', 1)[1].strip() for line in link
+                       if line.startswith('file:')]
+    except IOError as error:
+        # raster in a mapset of another user may not be readable
+        return error.errno != errno.ENOENT
+    while sources:
+        source = sources.pop()
+        if path in source:
+            return True
+        if source.endswith('.vrt') and os.path.exists(source):
+            with open(source) as vrt:
+                text = vrt.read()
+            if path in text:
+                return True
+            sources.extend(re.findall(r'>([^<>]+\.vrt)<', text))
+    return False
+
+
+def file_checksum(path):
+    """Return MD5 hash object of file content"""
+    checksum = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum
+
+
+class TileManifest(object):
+    """Index of local files with their source and processing state
+
+    Records are stored in SQLite database in the output directory and
+    keyed by download URL. Validity of a file is decided from its size
+    and modification time recorded when it was checked last time,
+    so files do not need to be read on each run. When these differ,
+    the file is verified using its recorded checksum. A file whose size
+    reported by TNM changed is outdated.
+    """
+    columns = ('title', 'path', 'size', 'checksum', 'etag', 'last_modified',
+               'file_size', 'file_mtime', 'zip_member', 'extracted', 'imported')
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tiles ("
+                "url TEXT PRIMARY KEY, title TEXT, path TEXT, size INTEGER,"
+                "checksum TEXT, etag TEXT, last_modified TEXT,"
+                "file_size INTEGER, file_mtime REAL, zip_member TEXT,"
+                "extracted TEXT, imported TEXT)")
+
+    def get(self, url):
+        """Return record for URL as dictionary or None"""
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM tiles WHERE url = ?",
+                                          (url,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, url, **values):
+        """Create or update record for URL"""
+        for column in values:
+            if column not in self.columns:
+                raise ValueError(column)
+        columns = sorted(values)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO tiles (url) VALUES (?)",
+                                    (url,))
+            if columns:
+                self.connection.execute(
+                    "UPDATE tiles SET {0} WHERE url = ?".format(
+                        ", ".join(column + " = ?" for column in columns)),
+                    [values[column] for column in columns] + [url])
+
+    def record_file(self, url, path, **values):
+        """Record current size and modification time of a valid file"""
+        stat = os.stat(path)
+        self.update(url, path=path, file_size=stat.st_size,
+                    file_mtime=stat.st_mtime, **values)
+
+    def file_valid(self, url, path, size):
+        """Check that local file is complete and not corrupted"""
+        if not os.path.exists(path):
+            return False
+        record = self.get(url)
+        if not record or record['path'] != path:
+            # file not known yet, only its size can be checked
+            if not local_file_complete(path, size):
+                return False
+            self.record_file(url, path, size=size)
+            return True
+        if record['size'] is not None and record['size'] != size:
+            # file changed on the server under the same URL,
+            # the outdated file cannot be resumed
+            os.remove(path)
+            return False
+        stat = os.stat(path)
+        if (record['file_size'] == stat.st_size and
+                record['file_mtime'] == stat.st_mtime):
+            return True
+        # file changed since it was checked
+        if record['checksum']:
+            valid = file_checksum(path).hexdigest() == record['checksum']
+        else:
+            valid = local_file_complete(path, size)
+        if valid:
+            self.record_file(url, path)
+        return valid
+
+    def resume_validator(self, url, path, size):
+        """Return validator for resuming partial download of URL
+
+        Size, ETag and Last-Modified are recorded when a download starts.
+        Partial download of a file whose size reported by TNM changed
+        is removed. Returns ETag (unless weak) or Last-Modified for
+        If-Range header, so that the server sends the whole file
+        when it changed, None when unknown.
+        """
+        partial_path = path + '.part'
+        if not os.path.exists(partial_path):
+            return None
+        record = self.get(url)
+        if not record:
+            return None
+        if record['size'] is not None and record['size'] != size:
+            os.remove(partial_path)
+            return None
+        return http_validator(record['etag'], record['last_modified'])
+
+
+def http_validator(etag, last_modified):
+    """Return ETag or Last-Modified usable in If-Range header or None"""
+    # weak ETag cannot be used in If-Range
+    if etag and not etag.startswith('W/'):
+        return etag
+    return last_modified
+
+
+def local_file_complete(local_file_path, size, tolerance=5):
+    """Check that local file exists and its size matches the expected size"""
+    if not os.path.exists(local_file_path):
+        return False
+    return abs(os.path.getsize(local_file_path) - size) <= tolerance
+
+
+def prepare_partial_download(local_file_path, size):
+    """Turn incomplete local file into a partial download
+
+    Shorter file is an interrupted download, so it is resumed,
+    a longer file is removed and downloaded again.
+    """
+    partial_file_path = local_file_path + '.part'
+    if not os.path.exists(local_file_path):
+        return
+    if (os.path.getsize(local_file_path) < size and
+            not os.path.exists(partial_file_path)):
+        os.rename(local_file_path, partial_file_path)
+    else:
+        os.remove(local_file_path)
+
+
+class TileCache(object):
+    """Cache of downloaded files shared by users and processes
+
+    Files are stored under a key computed from their download URL
+    and size, so a file changed on the server gets a new entry.
+    Entries are guarded by two lock files: processes using a file hold
+    a shared lock on the entry lock until they end, so that the file
+    is not evicted, and the process downloading a file holds
+    an exclusive lock on the download lock, so that other processes
+    wait for the file instead of downloading it again. The download
+    lock is only held during the download and only taken without
+    waiting, so processes using the same entries cannot deadlock.
+    When the total size exceeds the budget, the least recently used
+    entries are removed, except for entries pinned by linked rasters.
+    """
+    def __init__(self, directory, max_bytes=0):
+        self.directory = directory
+        self.data_dir = os.path.join(directory, 'data')
+        self.lock_dir = os.path.join(directory, 'locks')
+        self.pin_dir = os.path.join(directory, 'pins')
+        self.max_bytes = max_bytes
+        # lock files held by this process
+        self.locks = {}
+        self.lock = threading.Lock()
+        for path in (self.data_dir, self.lock_dir, self.pin_dir):
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # created by another process in the meantime
+                    if not os.path.isdir(path):
+                        raise
+
+    def entry_path(self, url, size, file_name):
+        """Return path of the cached file for given URL and size"""
+        key = hashlib.sha1('{0}\n{1}'.format(url, size)).hexdigest()
+        return os.path.join(self.data_dir, key[:2], key, file_name)
+
+    def contains(self, path):
+        """Check if path is inside the cache"""
+        return os.path.abspath(path).startswith(
+            os.path.abspath(self.data_dir) + os.sep)
+
+    def _lock_file(self, path, suffix='.lock'):
+        key = os.path.basename(os.path.dirname(path))
+        return os.path.join(self.lock_dir, key + suffix)
+
+    def acquire(self, path):
+        """Lock cache entry as used and mark it as recently used
+
+        The shared lock is held until the process ends.
+        """
+        with self.lock:
+            lock_file = self.locks.get(path)
+            if lock_file is None:
+                lock_file = open(self._lock_file(path), 'a')
+                self.locks[path] = lock_file
+        if fcntl:
+            # waits only while the entry is being evicted
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+        # entry directory is created only under the lock,
+        # so that it is not evicted by another process meanwhile
+        entry_dir = os.path.dirname(path)
+        if not os.path.exists(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                # parent directory created by another process
+                if not os.path.isdir(entry_dir):
+                    raise
+        if os.path.exists(path):
+            # modification time of the entry is used for LRU eviction
+            os.utime(path, None)
+
+    def lock_download(self, path):
+        """Lock entry for download without waiting
+
+        Returns the lock file to be passed to unlock_download(),
+        or None when another process is downloading the file.
+        """
+        lock_file = open(self._lock_file(path, '.download'), 'a')
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                return None
+        return lock_file
+
+    def unlock_download(self, lock_file):
+        """Release lock returned by lock_download()"""
+        lock_file.close()
+
+    def wait_download(self, path):
+        """Wait until another process finishes download of the file"""
+        with open(self._lock_file(path, '.download'), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+
+    def pin(self, path, mapset_path, raster):
+        """Keep entry used by raster linked with r.external
+
+        The pin file records the raster and the mapset. The entry is not
+        evicted while the raster exists and reads the file, more rasters
+        can pin the same entry.
+        """
+        pin_path = os.path.join(self.pin_dir, os.path.basename(os.path.dirname(path)))
+        line = '{0}\t{1}\t{2}\n'.format(os.path.abspath(path), mapset_path, raster)
+        with self.lock:
+            if os.path.exists(pin_path):
+                with open(pin_path) as pin_file:
+                    if line in pin_file.readlines():
+                        return
+            with open(pin_path, 'a') as pin_file:
+                pin_file.write(line)
+
+    def pinned(self, entry_dir):
+        """Check that entry is pinned by an existing linked raster
+
+        Pin file of an entry which is not used by any linked raster
+        anymore (the raster was removed or linked to other files)
+        is removed.
+        """
+        pin_path = os.path.join(self.pin_dir, os.path.basename(entry_dir))
+        if not os.path.exists(pin_path):
+            return False
+        with open(pin_path) as pin_file:
+            pins = [line.rstrip('\n').split('\t') for line in pin_file if line.strip()]
+        for path, mapset_path, raster in pins:
+            if linked_raster_reads(mapset_path, raster, path):
+                return True
+        gscript.verbose(_("Removing pin of {0}, linked rasters do not exist").format(entry_dir))
+        os.remove(pin_path)
+        return False
+
+    def release(self):
+        """Release all locks held by this process"""
+        with self.lock:
+            for lock_file in self.locks.values():
+                lock_file.close()
+            self.locks = {}
+
+    def evict(self):
+        """Remove least recently used entries until cache fits the budget"""
+        if not self.max_bytes:
+            return
+        entries = []
+        total_size = 0
+        for prefix in os.listdir(self.data_dir):
+            prefix_dir = os.path.join(self.data_dir, prefix)
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                size = 0
+                last_used = 0
+                try:
+                    for name in os.listdir(entry_dir):
+                        stat = os.stat(os.path.join(entry_dir, name))
+                        size += stat.st_size
+                        last_used = max(last_used, stat.st_mtime)
+                except OSError:
+                    # removed by another process
+                    continue
+                entries.append((last_used, size, entry_dir))
+                total_size += size
+        for last_used, size, entry_dir in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if self.pinned(entry_dir):
+                continue
+            lock_path = os.path.join(self.lock_dir, os.path.basename(entry_dir) + '.lock')
+            with open(lock_path, 'a') as lock_file:
+                if fcntl:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        # entry is being downloaded or used
+                        continue
+                if os.path.abspath(entry_dir) in [os.path.dirname(os.path.abspath(path))
+                                                  for path in self.locks]:
+                    continue
+                gscript.verbose(_("Removing {0} from cache").format(entry_dir))
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total_size -= size
+
+
+class FileProgress(object):
+    """Progress of one download attempt reported to the job progress
+
+    When the attempt fails, its progress is subtracted, so that
+    a repeated attempt is not counted twice.
+    """
+    def __init__(self, progress):
+        self.progress = progress
+        self.done_bytes = 0
+
+    def update(self, nbytes):
+        self.done_bytes += nbytes
+        self.progress.update(nbytes)
+
+    def rollback(self):
+        self.progress.update(-self.done_bytes)
+        self.done_bytes = 0
+
+
+class ScratchSpace(object):
+    """Budget of disk space for downloaded and extracted files
+
+    Space for a download is reserved before it starts and the download
+    waits while the budget is exhausted, unless nothing is reserved,
+    so that a file larger than the budget can still be processed.
+    Space of extracted files is added without waiting, because it can
+    be released only after the tile is imported.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, nbytes, wait=True):
+        with self.condition:
+            while wait and self.used and self.used + nbytes > self.limit:
+                self.condition.wait(1)
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used -= nbytes
+            self.condition.notify_all()
+
+
+class DownloadProgress(object):
+    """Progress of all downloads of one job shared by download threads
+
+    Progress is reported when the integer percentage changes,
+    but at most once in min_interval seconds.
+    """
+    def __init__(self, total_bytes, total_count, min_interval=0.5):
+        self.total_bytes = max(total_bytes, 1)
+        self.done_bytes = 0
+        self.last_percent = -1
+        self.min_interval = min_interval
+        self.last_time = 0
+        self.total_count = total_count
+        self.done_count = 0
+        self.lock = threading.Lock()
+
+    def file_completed(self):
+        with self.lock:
+            self.done_count += 1
+            gscript.info("Download {0} of {1}: COMPLETE".format(
+                self.done_count, self.total_count))
+
+    def update(self, nbytes):
+        with self.lock:
+            self.done_bytes += nbytes
+            percent = min(100, self.done_bytes * 100 // self.total_bytes)
+            if percent == self.last_percent:
+                return
+            now = time.time()
+            if percent == 100 or now - self.last_time >= self.min_interval:
+                self.last_percent = percent
+                self.last_time = now
+                gscript.percent(percent, 100, 1)
+
+
+class ChecksumError(IOError):
+    """Downloaded data do not match checksum provided by the server"""
+    pass
+
+
+def transient_error(error):
+    """Check if error is likely to disappear when the request is repeated"""
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in (408, 429, 500, 502, 503, 504)
+    return isinstance(error, (urllib2.URLError, httplib.HTTPException,
+                              socket.error, ChecksumError))
+
+
+def retry(function, retries, max_retry_time, description, base_delay=1,
+          max_delay=120):
+    """Call function, retry on transient errors with exponential backoff
+
+    Delay before each retry is drawn randomly (full jitter) from an
+    exponentially growing interval, so that parallel downloads do not
+    retry at the same time. Server's Retry-After header is respected.
+    The error is raised when retries are exhausted or the total
+    time of waiting would exceed max_retry_time seconds.
+    """
+    waited = 0
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except Exception as error:
+            if attempt == retries or not transient_error(error):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if isinstance(error, urllib2.HTTPError):
+                try:
+                    delay = max(delay, float(error.hdrs.getheader('Retry-After')))
+                except (TypeError, ValueError):
+                    pass
+            if waited + delay > max_retry_time:
+                raise
+            gscript.verbose(_("{0} failed ({1}), retrying in {2:.1f} s").format(
+                description, error, delay))
+            time.sleep(delay)
+            waited += delay
+
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def next_chunk_size(chunk_size, received, seconds):
+    """Adapt size of the next read to the speed of the connection
+
+    Chunk grows while full chunks arrive quickly, so that fast
+    downloads need few reads, and shrinks when a read takes long,
+    so that progress is reported and interruption noticed in time.
+    """
+    if received == chunk_size and seconds < 0.1:
+        return min(chunk_size * 2, MAX_CHUNK_SIZE)
+    if seconds > 1:
+        return max(chunk_size // 2, MIN_CHUNK_SIZE)
+    return chunk_size
+
+
+def download_file(url, local_file_path, progress, max_attempts=3, size=None,
+                  validator=None, started=None):
+    """Download file in chunks rather than write complete file to memory
+
+    Data are written to a '.part' file which is renamed when the download
+    is complete. Download of an existing '.part' file is resumed
+    with an HTTP Range request when the server supports it.
+    When the connection fails or times out during the download,
+    the download is resumed from the last received byte.
+
+    Data are read in chunks of adaptive size and the '.part' file
+    always holds only the received data, so that the download can be
+    resumed also after the process is killed. Without
+    Content-Length header, the expected size (if given) is used
+    to detect an incomplete download.
+
+    Range request includes If-Range header with validator (ETag or
+    Last-Modified) of the file being resumed, if given, so that
+    the server sends the whole file when it changed. Function started
+    is called with ETag and Last-Modified of each response before
+    its data are written.
+
+    Returns dictionary with MD5 checksum of the file and its ETag
+    and Last-Modified headers. When ETag is an MD5 checksum
+    (as for files on Amazon S3) and the checksum of the downloaded
+    data differs, the file is removed and IOError is raised.
+    """
+    chunk_size = MIN_CHUNK_SIZE
+    part_path = local_file_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    # checksum is computed as the data arrive,
+    # only the already downloaded part needs to be read
+    checksum = file_checksum(part_path) if offset else hashlib.md5()
+    progress.update(offset)
+    accepts_ranges = True
+    attempts = 0
+    etag = last_modified = None
+    while True:
+        attempts += 1
+        received = 0
+        headers = {}
+        if offset and accepts_ranges:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            if validator:
+                headers['If-Range'] = validator
+        try:
+            try:
+                dwnld_req = http_get(url, headers=headers)
+            except urllib2.HTTPError as error:
+                # requested range starts at the end of the file,
+                # so the previous download was complete
+                if error.code == 416 and offset:
+                    total = content_range_total(error.hdrs.getheader('Content-Range'))
+                    if total == offset:
+                        break
+                    # otherwise the remote file changed, start again
+                    progress.update(-offset)
+                    offset = 0
+                    checksum = hashlib.md5()
+                    os.remove(part_path)
+                    continue
+                raise
+            accepts_ranges = dwnld_req.getheader('Accept-Ranges', '') == 'bytes'
+            etag = dwnld_req.getheader('ETag')
+            last_modified = dwnld_req.getheader('Last-Modified')
+            validator = http_validator(etag, last_modified)
+            if started:
+                started(etag, last_modified)
+            if dwnld_req.status == 206:
+                mode = "ab"
+            else:
+                # server ignored the Range header and sends the whole file
+                progress.update(-offset)
+                offset = 0
+                checksum = hashlib.md5()
+                mode = "wb"
+            content_length = dwnld_req.getheader('Content-Length')
+            expected = offset + int(content_length) if content_length else None
+            with open(part_path, mode) as local_file:
+                while True:
+                    start = time.time()
+                    chunk = dwnld_req.read(chunk_size)
+                    if not chunk:
+                        break
+                    local_file.write(chunk)
+                    checksum.update(chunk)
+                    received += len(chunk)
+                    progress.update(len(chunk))
+                    chunk_size = next_chunk_size(chunk_size, len(chunk),
+                                                 time.time() - start)
+            # connection closed by the server before the end of data
+            if expected and offset + received < expected:
+                raise httplib.HTTPException("Connection closed after {0} of {1} bytes".format(
+                    offset + received, expected))
+            if not expected and size and not local_file_complete(part_path, size):
+                raise httplib.HTTPException("Connection closed after {0} of {1} bytes".format(
+                    os.path.getsize(part_path), size))
+            break
+        except (httplib.HTTPException, socket.error, urllib2.URLError) as error:
+            if isinstance(error, urllib2.HTTPError):
+                raise
+            close_connections()
+            offset += received
+            if not accepts_ranges:
+                # the download can be repeated only from the beginning
+                progress.update(-offset)
+                offset = 0
+                checksum = hashlib.md5()
+            elif received:
+                # keep resuming while the attempts bring new data
+                attempts = 0
+            if attempts >= max_attempts:
+                raise
+            gscript.verbose(_("Download of {0} interrupted, resuming from byte {1}").format(
+                url, offset))
+    checksum = checksum.hexdigest()
+    if etag and re.match(r'^"?[0-9a-f]{32}"?$', etag) and etag.strip('"') != checksum:
+        os.remove(part_path)
+        raise ChecksumError("Checksum of downloaded file {0} does not match".format(url))
+    if os.path.exists(local_file_path):
+        os.remove(local_file_path)
+    os.rename(part_path, local_file_path)
+    return {'checksum': checksum, 'etag': etag, 'last_modified': last_modified}
+
+
+def download_tile(url, local_file_path, size, progress, cache=None,
+                  manifest=None):
+    """Download file unless it is already complete
+
+    If cache is given, the download is coordinated with other processes
+    using the same cache and a file downloaded meanwhile by another
+    process is not downloaded again. If manifest is given, the file
+    is validated and recorded in the manifest.
+    """
+    if cache:
+        cache.acquire(local_file_path)
+    download_lock = None
+    try:
+        # file being downloaded by another process is waited for
+        # and checked again, also after the lock is taken
+        while True:
+            if manifest:
+                complete = manifest.file_valid(url, local_file_path, size)
+            else:
+                complete = local_file_complete(local_file_path, size)
+            if complete or not cache or download_lock:
+                break
+            download_lock = cache.lock_download(local_file_path)
+            if not download_lock:
+                cache.wait_download(local_file_path)
+        if complete:
+            progress.update(size)
+        else:
+            prepare_partial_download(local_file_path, size)
+            validator = None
+            started = None
+            if manifest:
+                validator = manifest.resume_validator(url, local_file_path, size)
+
+                def started(etag, last_modified):
+                    # partial file of another version is not resumed
+                    manifest.update(url, size=size, etag=etag,
+                                    last_modified=last_modified)
+            info = download_file(url, local_file_path, progress, size=size,
+                                 validator=validator, started=started)
+            if manifest:
+                manifest.record_file(url, local_file_path, size=size,
+                                     extracted=None, imported=None, **info)
+    finally:
+        if download_lock:
+            cache.unlock_download(download_lock)
+
+
+class Pipeline(object):
+    """Chain of processing stages connected by bounded queues
+
+    Each stage processes items in its own worker threads and passes
+    each item to the next stage as soon as it is done, so that
+    for example one tile is imported while another one is extracted
+    and yet another one downloaded. After the first error,
+    remaining items are skipped, unless stop_on_error is False;
+    then only the failed item is not processed further.
+    """
+    _end = object()
+
+    def __init__(self, stop_on_error=True):
+        self.stages = []
+        # (stage name, item, exception)
+        self.errors = []
+        self.stop_on_error = stop_on_error
+        self.stopped = threading.Event()
+
+    def add_stage(self, name, function, workers=1):
+        """Add stage processing an item by function(item)
+
+        The function returns the item passed to the next stage.
+        """
+        self.stages.append((name, function, max(1, workers)))
+
+    def run(self, items):
+        """Process items by all stages, return results of the last stage
+
+        Results are in the order of items, None for skipped items.
+        """
+        results = [None] * len(items)
+        lock = threading.Lock()
+        # only the input of the first stage is unbounded
+        queues = [Queue.Queue()]
+        for name, function, workers in self.stages[1:]:
+            queues.append(Queue.Queue(maxsize=2 * workers))
+        running = [workers for name, function, workers in self.stages]
+        for index, item in enumerate(items):
+            queues[0].put((index, item))
+        for i in range(self.stages[0][2]):
+            queues[0].put(self._end)
+
+        def worker(stage):
+            name, function, workers = self.stages[stage]
+            last_stage = stage + 1 == len(self.stages)
+            while True:
+                entry = queue_get(queues[stage])
+                if entry is self._end:
+                    break
+                # items are still taken after an error,
+                # so that preceding stages do not block
+                if self.stopped.is_set():
+                    continue
+                index, item = entry
+                try:
+                    item = function(item)
+                except Exception as error:
+                    with lock:
+                        self.errors.append((name, item, error))
+                    if self.stop_on_error:
+                        self.stopped.set()
+                    continue
+                if last_stage:
+                    results[index] = item
+                else:
+                    queues[stage + 1].put((index, item))
+            with lock:
+                running[stage] -= 1
+                stage_done = not running[stage]
+            if stage_done and not last_stage:
+                for i in range(self.stages[stage + 1][2]):
+                    queues[stage + 1].put(self._end)
+
+        threads = []
+        for stage, (name, function, workers) in enumerate(self.stages):
+            for i in range(workers):
+                thread = threading.Thread(target=profile.thread_target(worker), args=(stage,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            # join with timeout keeps the main thread responsive to Ctrl+C
+            while thread.is_alive():
+                thread.join(1)
+        return results
+
+
+class Profile(object):
+    """Timings of stages, tiles and GRASS modules of one run
+
+    Nothing is recorded until the profile is enabled, so that it can be
+    used unconditionally. Times are in seconds since start of the run.
+    Modules are attributed to the stage and tile processed by the
+    thread which runs them. With Python profiler, each thread running
+    a target wrapped by thread_target() is profiled separately and
+    the statistics are merged when written.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.python_profiles = []
+
+    def enable(self, path, python_profile=False):
+        self.enabled = True
+        self.path = path
+        self.start = time.time()
+        self.start_times = os.times()
+        self.info = {}
+        self.stages = {}
+        self.tiles = {}
+        self.modules = []
+        if python_profile:
+            self.python_profiles.append(cProfile.Profile())
+            self.python_profiles[0].enable()
+
+    def now(self):
+        return time.time() - self.start
+
+    def set_context(self, stage, url=None):
+        """Set stage and tile of modules run by the current thread"""
+        self.local.context = (stage, url)
+
+    def begin(self, name):
+        """Begin stage of the whole run in the current thread, return its start"""
+        self.set_context(name)
+        return self.now()
+
+    def end(self, name, start):
+        self.set_context(None)
+        self.add_stage(name, start, self.now())
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record wall time of stage of the whole run"""
+        start = self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name, start)
+
+    def tile_stage(self, name, function, nbytes=None):
+        """Wrap pipeline stage function(tile) to record time of each tile
+
+        Bytes processed by the stage are given by nbytes(tile).
+        """
+        def stage(tile):
+            if not self.enabled:
+                return function(tile)
+            url = tile['url']
+            self.set_context(name, url)
+            start = self.now()
+            try:
+                tile = function(tile)
+            except Exception as error:
+                self.add_stage(name, start, self.now(), url)
+                with self.lock:
+                    self.tiles[url]['error'] = "{0}: {1}".format(name, error)
+                raise
+            finally:
+                self.set_context(None)
+            self.add_stage(name, start, self.now(), url, nbytes(tile) if nbytes else None)
+            return tile
+        return stage
+
+    def add_stage(self, name, start, end, url=None, nbytes=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.setdefault(name, {'start': start, 'end': end,
+                                                  'seconds': 0, 'count': 0,
+                                                  'bytes': 0})
+            stage['start'] = min(stage['start'], start)
+            stage['end'] = max(stage['end'], end)
+            stage['seconds'] += end - start
+            stage['count'] += 1
+            stage['bytes'] += nbytes or 0
+            if url:
+                record = {'start': start, 'seconds': end - start}
+                if nbytes is not None:
+                    record['bytes'] = nbytes
+                    record['MBps'] = throughput(nbytes, end - start)
+                self.tiles.setdefault(url, {})[name] = record
+
+    def wait(self, module, process, start):
+        """Wait for module started at start (time.time()), return its return code
+
+        CPU time of the module is taken from resource usage
+        of the terminated process where available.
+        """
+        if not self.enabled or not hasattr(os, 'wait4'):
+            returncode = process.wait()
+            self.add_module(module, start, returncode)
+            return returncode
+        while True:
+            try:
+                pid, status, usage = os.wait4(process.pid, 0)
+                break
+            except OSError as error:
+                if error.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        self.add_module(module, start, process.returncode, usage)
+        return process.returncode
+
+    def communicate(self, module, process, start, data):
+        """Send data to standard input of module, return its standard output"""
+        if not self.enabled:
+            return process.communicate(data)[0]
+        def write():
+            process.stdin.write(data)
+            process.stdin.close()
+        writer = threading.Thread(target=write)
+        writer.start()
+        output = process.stdout.read()
+        writer.join()
+        self.wait(module, process, start)
+        return output
+
+    def add_module(self, module, start, returncode, usage=None):
+        if not self.enabled:
+            return
+        stage, url = getattr(self.local, 'context', (None, None))
+        record = {'module': module, 'stage': stage, 'tile': url,
+                  'start': start - self.start, 'wall': time.time() - start,
+                  'returncode': returncode}
+        if usage:
+            record['cpu_user'] = usage.ru_utime
+            record['cpu_system'] = usage.ru_stime
+            record['max_rss_kb'] = usage.ru_maxrss
+        with self.lock:
+            self.modules.append(record)
+
+    def thread_target(self, function):
+        """Wrap target of a thread started by the current thread
+
+        The thread inherits stage and tile of the current thread
+        and it is profiled by its own Python profiler.
+        """
+        if not self.enabled:
+            return function
+        context = getattr(self.local, 'context', (None, None))
+        def target(*args):
+            self.local.context = context
+            if not self.python_profiles:
+                return function(*args)
+            python_profile = cProfile.Profile()
+            with self.lock:
+                self.python_profiles.append(python_profile)
+            python_profile.runcall(function, *args)
+        return target
+
+    def report(self):
+        """Return report as dictionary serializable to JSON"""
+        times = os.times()
+        stages = {}
+        for name, stage in self.stages.items():
+            wall = stage['end'] - stage['start']
+            stages[name] = {'start': stage['start'], 'wall': wall,
+                            'busy': stage['seconds'], 'count': stage['count'],
+                            'bytes': stage['bytes'],
+                            'MBps': throughput(stage['bytes'], wall)}
+        module_totals = {}
+        for record in self.modules:
+            total = module_totals.setdefault(record['module'], {
+                'count': 0, 'wall': 0, 'cpu_user': 0, 'cpu_system': 0})
+            total['count'] += 1
+            for key in ('wall', 'cpu_user', 'cpu_system'):
+                total[key] += record.get(key, 0)
+        tiles = []
+        for url, record in sorted(self.tiles.items()):
+            record = dict(record)
+            record['url'] = url
+            tiles.append(record)
+        report = {'version': 1,
+                  'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)),
+                  'wall': self.now(),
+                  'cpu_user': times[0] - self.start_times[0],
+                  'cpu_system': times[1] - self.start_times[1],
+                  'children_cpu_user': times[2] - self.start_times[2],
+                  'children_cpu_system': times[3] - self.start_times[3],
+                  'stages': stages,
+                  'tiles': tiles,
+                  'modules': self.modules,
+                  'module_totals': module_totals}
+        report.update(self.info)
+        return report
+
+    def write(self):
+        """Write JSON report and Python profiler statistics"""
+        if not self.enabled:
+            return
+        with open(self.path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=1, sort_keys=True)
+        if self.python_profiles:
+            self.python_profiles[0].disable()
+            stats = pstats.Stats(*self.python_profiles)
+            stats.dump_stats(os.path.splitext(self.path)[0] + '.prof')
+        self.enabled = False
+
+
+def throughput(nbytes, seconds):
+    """Return throughput in MB/s or None when it cannot be computed"""
+    if not nbytes or seconds <= 0:
+        return None
+    return nbytes / (1024. * 1024) / seconds
+
+
+profile = Profile()
+
+
+def size_str(nbytes):
+    """Return size in bytes formatted in MB or GB"""
+    if len(str(nbytes)) < 10:
+        return "{0:.2f} MB".format(nbytes * 1e-6)
+    return "{0:.2f} GB".format(nbytes * 1e-9)
+
+
+def run_module(module, **kwargs):
+    """Run GRASS module like gscript.run_command, recording its time in profile"""
+    if not profile.enabled:
+        return gscript.run_command(module, **kwargs)
+    start = time.time()
+    process = gscript.start_command(module, **kwargs)
+    returncode = profile.wait(module, process, start)
+    if returncode:
+        raise CalledModuleError(module, kwargs, returncode)
+    return 0
+
+
+# Hard-coded parameters needed for USGS datasets
+usgs_product_dict = {
+    "ned": {
+            'product': 'National Elevation Dataset (NED)',
+            'dataset': {
+                    'ned1sec': (1. / 3600, 30, 100),
+                    'ned13sec': (1. / 3600 / 3, 10, 30),
+                    'ned19sec': (1. / 3600 / 9, 3, 10)
+                    },
+            'subset': {},
+            'extent': [
+                    '1 x 1 degree',
+                    '15 x 15 minute'
+                     ],
+            'format': 'IMG',
+            'extension': 'img',
+            'zip': True,
+            'srs': 'wgs84',
+            'srs_proj4': "+proj=longlat +ellps=GRS80 +datum=NAD83 +nodefs",
+            'interpolation': 'bilinear',
+            'url_split': '/'
+            },
+    "nlcd": {
+            'product': 'National Land Cover Database (NLCD)',
+            'dataset': {
+                    'National Land Cover Database (NLCD) - 2001': (1. / 3600, 30, 100),
+                    'National Land Cover Database (NLCD) - 2006': (1. / 3600, 30, 100),
+                    'National Land Cover Database (NLCD) - 2011': (1. / 3600, 30, 100)
+                    },
+            'subset': {
+                    'Percent Developed Imperviousness',
+                    'Percent Tree Canopy',
+                    'Land Cover'
+                    },
+            'extent': ['3 x 3 degree'],
+            'format': 'GeoTIFF',
+            'extension': 'tif',
+            'zip': True,
+            'srs': 'wgs84',
+            'srs_proj4': "+proj=longlat +ellps=GRS80 +datum=NAD83 +nodefs",
+            'interpolation': 'nearest',
+            'url_split': '/'
+            },
+    "naip": {
+            'product': 'USDA National Agriculture Imagery Program (NAIP)',
+            'dataset': {
+                    'Imagery - 1 meter (NAIP)': (1. / 3600 / 27, 1, 3)},
+            'subset': {},
+            'extent': [
+                    '3.75 x 3.75 minute',
+                     ],
+            'format': 'JPEG2000',
+            'extension': 'jp2',
+            'zip': False,
+            'srs': 'wgs84',
+            'srs_proj4': "+proj=longlat +ellps=GRS80 +datum=NAD83 +nodefs",
+            'interpolation': 'nearest',
+            'url_split': '/'
             }
+}
+
+
+def location_resolution_index(location_srs):
+    """Return index of resolution in units of the location
+
+    Index is 0 for degrees, 1 for meters and 2 for feet
+    in resolutions of datasets in the USGS product dictionary,
+    None when units of the location are unknown.
+    """
+    try:
+        if location_srs:
+            is_latlong = location_srs.IsGeographic()
+            meters = location_srs.GetLinearUnits()
+        else:
+            proj = gscript.parse_command('g.proj', flags='g')
+            is_latlong = gscript.locn_is_latlong()
+            meters = None if is_latlong else float(proj['meters'])
+    except TypeError:
+        return None
+    if is_latlong:
+        return 0
+    elif meters == 1:
+        return 1
+    # we assume feet
+    return 2
+
+
+def auto_ned_dataset(region_resolution, resolution_index):
+    """Return coarsest NED dataset with resolution meeting region resolution
+
+    The resolution_index selects resolution in degrees, meters or feet
+    in the USGS product dictionary. The finest dataset is returned
+    when no dataset is fine enough.
+    """
+    datasets = sorted(usgs_product_dict['ned']['dataset'].items(),
+                      key=lambda item: item[1][resolution_index], reverse=True)
+    for dataset, resolutions in datasets:
+        # tolerate rounding of region resolution
+        if resolutions[resolution_index] <= region_resolution * (1 + 1e-6):
+            return dataset
+    return datasets[-1][0]
+
+
+def import_product(options, shared):
+    """Import one product, dataset and subset given by options
 
+    Generator which queries the TNM API and selects the tiles, then
+    yields the tiles to be downloaded, extracted and imported by the
+    caller together with tiles of other products. The stage functions
+    are given in each tile. The processed tiles (None for failed ones)
+    and the errors are sent back, and the tiles are patched.
+    Resources of the run (manifest, caches, scratch space, worker
+    mapsets and progress) are given in shared.
+    """
     # Set GRASS GUI options and flags to python variables
     gui_product = options['product']
 
@@ -195,8 +2263,24 @@ def main():
     product_extent = nav_string['extent']
     gui_subset = None
 
+    # Returns current units, index of product resolution
+    # in the USGS product dictionary
+    location_srs = get_location_srs()
+    resolution_index = location_resolution_index(location_srs)
+    gregion = gscript.region()
+
     # Parameter assignments for each dataset
     if gui_product == 'ned':
+        ned_auto = options['ned_dataset'] == 'auto'
+        if ned_auto:
+            if resolution_index is None:
+                gscript.warning(_("Units of the location are unknown, using NED dataset <ned1sec>"))
+                options['ned_dataset'] = 'ned1sec'
+            else:
+                region_resolution = min(gregion['nsres'], gregion['ewres'])
+                options['ned_dataset'] = auto_ned_dataset(region_resolution, resolution_index)
+                gscript.message(_("NED dataset <{0}> selected for resolution {1:g} of the computational region").format(
+                    options['ned_dataset'], region_resolution))
         gui_dataset = options['ned_dataset']
         ned_api_name = ''
         if options['ned_dataset'] == 'ned1sec':
@@ -234,81 +2318,159 @@ def main():
     # Assigning further parameters from GUI
     gui_output_layer = options['output_name']
     gui_resampling_method = options['resampling_method']
+    gui_naip_composite = options['naip_composite']
+    gui_mask = options['mask']
+    gui_aoi = options['aoi']
     gui_i_flag = flags['i']
     gui_k_flag = flags['k']
+    gui_e_flag = flags['e']
+    gui_m_flag = flags['m']
+    gui_r_flag = flags['r']
+    gui_a_flag = flags['a']
+    gui_l_flag = flags['l']
+    gui_w_flag = flags['w']
+    if gui_m_flag and not gdal:
+        gscript.fatal(_("GDAL Python bindings are required for <m> flag"))
+    if gui_w_flag and not gdal:
+        gscript.fatal(_("GDAL Python bindings are required for <w> flag"))
     work_dir = options['output_directory']
+    download_workers = int(options['download_workers'])
+    nprocs = int(options['nprocs'])
+    retries = int(options['retries'])
+    retry_time = int(options['retry_time'])
+    query_cache_ttl = int(options['query_cache_ttl'])
+    tile_cache = shared['tile_cache']
+    manifest = shared['manifest']
 
-    # Returns current units
-    try:
-        proj = gscript.parse_command('g.proj', flags='g')
-        if gscript.locn_is_latlong():
-            product_resolution = nav_string['dataset'][gui_dataset][0]
-        elif float(proj['meters']) == 1:
-            product_resolution = nav_string['dataset'][gui_dataset][1]
-        else:
-            # we assume feet
-            product_resolution = nav_string['dataset'][gui_dataset][2]
-    except TypeError:
+    def local_path(TNM_file_URL, TNM_file_size):
+        # create file name by splitting name from returned url
+        # add file name to local download or cache directory
+        file_name = TNM_file_URL.split(product_url_split)[-1]
+        if gui_product == 'ned':
+            file_name = ned_data_abbrv + file_name
+        if tile_cache:
+            return tile_cache.entry_path(TNM_file_URL, TNM_file_size, file_name)
+        return os.path.join(work_dir, file_name)
+    gui_c_flag = flags['c']
+
+    if resolution_index is None:
         product_resolution = False
+    else:
+        product_resolution = nav_string['dataset'][gui_dataset][resolution_index]
 
     if gui_resampling_method == 'default':
         gui_resampling_method = nav_string['interpolation']
         gscript.verbose(_("The default resampling method for product {product} is {res}").format(product=gui_product,
                         res=product_interpolation))
 
-    # Get coordinates for current GRASS computational region and convert to USGS SRS
-    gregion = gscript.region()
-    min_coords = gscript.read_command('m.proj', coordinates=(gregion['w'], gregion['s']),
-                                      proj_out=product_proj4, separator='comma',
-                                      flags='d')
-    max_coords = gscript.read_command('m.proj', coordinates=(gregion['e'], gregion['n']),
-                                      proj_out=product_proj4, separator='comma',
-                                      flags='d')
-    min_list = min_coords.split(',')[:2]
-    max_list = max_coords.split(',')[:2]
-    list_bbox = min_list + max_list
-    str_bbox = ",".join((str(coord) for coord in list_bbox))
-
-    # Format variables for TNM API call
-    gui_prod_str = str(product_tag)
-    datasets = urllib.quote_plus(gui_prod_str)
-    prod_format = urllib.quote_plus(product_format)
-    prod_extent = urllib.quote_plus(product_extent[0])
-
-    # Create TNM API URL
-    base_TNM = "https://viewer.nationalmap.gov/tnmaccess/api/products?"
-    datasets_TNM = "datasets={0}".format(datasets)
-    bbox_TNM = "&bbox={0}".format(str_bbox)
-    prod_format_TNM = "&prodFormats={0}".format(prod_format)
-    TNM_API_URL = base_TNM + datasets_TNM + bbox_TNM + prod_format_TNM
+    # in batch mode, the region is set to the union of the areas
+    # of interest, each product gets its own copy of the areas
+    aois = copy.deepcopy(shared['aois'])
+
+    # Get boundary of current GRASS computational region and convert to USGS SRS,
+    # edges are densified, so that the bbox covers the whole reprojected region
+    region_boundary = transform_points(region_boundary_points(gregion),
+                                       product_proj4, location_srs)
+    list_bbox = normalize_bbox(points_bbox(region_boundary))
+    str_bbox = ",".join(("{0:.6f}".format(coord) for coord in list_bbox))
+
+    # tiles must intersect the reprojected region and the mask areas,
+    # not only the query bbox
+    tile_filters = [PolygonIndex([[region_boundary]])]
+    if gui_mask:
+        mask_polygons = vector_area_polygons(gui_mask)
+        if not mask_polygons:
+            gscript.fatal(_("Vector map <{0}> has no areas").format(gui_mask))
+        mask_polygons = transform_polygons(mask_polygons, product_proj4, location_srs)
+        tile_filters.append(PolygonIndex(mask_polygons))
+    if aois:
+        aoi_polygons = transform_polygons([polygon for aoi in aois for polygon in aoi['polygons']],
+                                          product_proj4, location_srs)
+        tile_filters.append(PolygonIndex(aoi_polygons))
+        aoi_polygons = iter(aoi_polygons)
+        for aoi in aois:
+            aoi['index'] = PolygonIndex([next(aoi_polygons) for polygon in aoi['polygons']])
+
+    # area of the region not covered by existing output in USGS SRS,
+    # tiles not intersecting it are skipped
+    existing_info = None
+    missing_index = None
+    if gui_a_flag:
+        if gui_product == 'naip':
+            existing_map = gui_output_layer + '.1'
+        else:
+            existing_map = gui_output_layer
+        if gscript.find_file(existing_map, element='cell', mapset='.')['file']:
+            existing_info = gscript.raster_info(existing_map)
+            existing_extents = raster_extents(existing_map)
+            # composite is extended as well when it exists
+            composite_exists = bool(gscript.find_file(gui_output_layer, element='cell',
+                                                      mapset='.')['file'])
+            missing = extent_difference(gregion, existing_extents)
+            if missing:
+                # boundaries of all rectangles are transformed at once,
+                # each has the same number of points
+                points = transform_points([point for rectangle in missing
+                                           for point in region_boundary_points(rectangle)],
+                                          product_proj4, location_srs)
+                count = len(points) // len(missing)
+                missing_index = PolygonIndex([[points[i:i + count]]
+                                              for i in range(0, len(points), count)])
+        else:
+            gscript.verbose(_("Raster <{0}> does not exist, importing all tiles").format(
+                existing_map))
+
+    # Format parameters for TNM API call
+    TNM_query = [('datasets', str(product_tag)),
+                 ('bbox', str_bbox),
+                 ('prodFormats', product_format)]
     if gui_product == 'nlcd':
-        TNM_API_URL += "&prodExtents={0}".format(prod_extent)
-    gscript.verbose("TNM API Query URL:\t{0}".format(TNM_API_URL))
+        TNM_query.append(('prodExtents', product_extent[0]))
 
-    # Query TNM API
-    try:
-        TNM_API_GET = urllib2.urlopen(TNM_API_URL, timeout=12)
-    except urllib2.URLError:
+    # Query first page of TNM API results or use cached results,
+    # the remaining pages are requested while the items are processed,
+    # the API endpoint can be replaced e.g. by a mirror or a test server
+    base_TNM = os.environ.get('R_IN_USGS_TNM_URL',
+                              "https://viewer.nationalmap.gov/tnmaccess/api/products?")
+    TNM_page_size = 100
+    query_start = profile.begin('query')
+    query_cache_dir = os.path.join(work_dir, '.tnm_query_cache')
+    first_page_query = TNM_query + [('offset', '0'), ('max', str(TNM_page_size))]
+    return_JSON = query_tnm(base_TNM, first_page_query, query_cache_dir,
+                            ttl=query_cache_ttl * 3600, offline=gui_c_flag)
+    if return_JSON is None:
+        if gui_c_flag:
+            gscript.fatal(_("No cached USGS TNM API query results for given input parameters. Run module without <c> flag."))
         gscript.fatal(_("USGS TNM API query has timed out. Check network configuration. Please try again."))
-    except:
-        gscript.fatal(_("USGS TNM API query has timed out. Check network configuration. Please try again."))
-
-    # Parse return JSON object from API query
-    try:
-        return_JSON = json.load(TNM_API_GET)
-        if return_JSON['errors']:
-            TNM_API_error = return_JSON['errors']
-            api_error_msg = "TNM API Error - {0}".format(str(TNM_API_error))
-            gscript.fatal(api_error_msg)
+    if return_JSON.get('errors'):
+        TNM_API_error = return_JSON['errors']
+        api_error_msg = "TNM API Error - {0}".format(str(TNM_API_error))
+        gscript.fatal(api_error_msg)
 
-    except:
-        gscript.fatal(_("Unable to load USGS JSON object."))
+    def imported_tile_layer(url, size):
+        # name of the tile imported by previous run with the same source
+        # and parameters, the name is recorded in the manifest
+        record = manifest.get(url)
+        if not record or not record['imported']:
+            return None
+        name = record['imported'].split('@')[0]
+        tag = tile_source_tag(url, size, product_resolution, product_interpolation)
+        if gui_product == 'naip':
+            names = [band_name(name, i) for i in ('1', '2', '3', '4')]
+        else:
+            names = [name]
+        if all(tile_raster_matches(band, tag) for band in names):
+            return name
+        return None
 
     # Functions down_list() and exist_list() used to determine
     # existing files and those that need to be downloaded.
     def down_list():
+        TNM_url_titles[TNM_file_URL] = TNM_file_title
+        TNM_url_sizes[TNM_file_URL] = TNM_file_size
         dwnld_url.append(TNM_file_URL)
         dwnld_size.append(TNM_file_size)
+        dwnld_url_size[TNM_file_URL] = TNM_file_size
         TNM_file_titles.append(TNM_file_title)
         if product_is_zip:
             extract_zip_list.append(local_zip_path)
@@ -317,6 +2479,8 @@ def main():
                 dataset_name.append(str(f['datasets'][0]))
 
     def exist_list():
+        TNM_url_titles[TNM_file_URL] = TNM_file_title
+        TNM_url_sizes[TNM_file_URL] = TNM_file_size
         exist_TNM_titles.append(TNM_file_title)
         exist_dwnld_url.append(TNM_file_URL)
         if product_is_zip:
@@ -328,11 +2492,18 @@ def main():
     # Assign needed parameters from returned JSON
     tile_API_count = int(return_JSON['total'])
     tiles_needed_count = 0
-    size_diff_tolerance = 5
+    incomplete_count = 0
+    covered_count = 0
+    outside_count = 0
     exist_dwnld_size = 0
+    reused_tiles = []
     if tile_API_count > 0:
         dwnld_size = []
         dwnld_url = []
+        dwnld_url_size = {}
+        TNM_url_titles = {}
+        TNM_url_sizes = {}
+        TNM_url_bboxes = {}
         dataset_name = []
         TNM_file_titles = []
         exist_dwnld_url = []
@@ -341,28 +2512,56 @@ def main():
         exist_tile_list = []
         extract_zip_list = []
         # for each file returned, assign variables to needed parameters
-        for f in return_JSON['items']:
+        TNM_items = iter_tnm_items(return_JSON, base_TNM, TNM_query,
+                                   query_cache_dir, query_cache_ttl * 3600,
+                                   gui_c_flag, download_workers, TNM_page_size)
+        # pages may overlap when results change between requests
+        seen_URLs = set()
+        for f in TNM_items:
+            if f['downloadURL'] in seen_URLs:
+                continue
+            seen_URLs.add(f['downloadURL'])
+            if f.get('boundingBox'):
+                tile_bbox = [float(f['boundingBox'][key]) for key in ('minX', 'minY', 'maxX', 'maxY')]
+                TNM_url_bboxes[str(f['downloadURL'])] = tile_bbox
+                # skip tiles outside of the region or mask,
+                # including tiles only touching it
+                tile_inner = [tile_bbox[0] + 1e-6, tile_bbox[1] + 1e-6,
+                              tile_bbox[2] - 1e-6, tile_bbox[3] - 1e-6]
+                if not all(tile_filter.intersects(tile_inner) for tile_filter in tile_filters):
+                    outside_count += 1
+                    continue
+                # skip tiles whose part in the region is covered by existing output
+                if existing_info:
+                    tile_part = bbox_intersection(tile_bbox, list_bbox)
+                    if not (tile_part and missing_index and
+                            missing_index.intersects(shrink_bbox(tile_part))):
+                        covered_count += 1
+                        continue
             TNM_file_title = f['title']
             TNM_file_URL = str(f['downloadURL'])
             TNM_file_size = int(f['sizeInBytes'])
-            TNM_file_name = TNM_file_URL.split(product_url_split)[-1]
-            if gui_product == 'ned':
-                local_file_path = os.path.join(work_dir, ned_data_abbrv + TNM_file_name)
-                local_zip_path = os.path.join(work_dir, ned_data_abbrv + TNM_file_name)
-                local_tile_path = os.path.join(work_dir, ned_data_abbrv + TNM_file_name)
-            else:
-                local_file_path = os.path.join(work_dir, TNM_file_name)
-                local_zip_path = os.path.join(work_dir, TNM_file_name)
-                local_tile_path = os.path.join(work_dir, TNM_file_name)
+            # tile imported by previous run from the same source is used
+            # without being downloaded, extracted or imported again
+            if gui_r_flag and (not gui_subset or gui_subset in TNM_file_title):
+                reused_layer = imported_tile_layer(TNM_file_URL, TNM_file_size)
+                if reused_layer:
+                    tiles_needed_count += 1
+                    TNM_url_titles[TNM_file_URL] = TNM_file_title
+                    reused_tiles.append({'url': TNM_file_URL, 'size': TNM_file_size,
+                                         'download': False, 'tile': None,
+                                         'layer': reused_layer,
+                                         'bbox': TNM_url_bboxes.get(TNM_file_URL)})
+                    continue
+            local_file_path = local_path(TNM_file_URL, TNM_file_size)
+            local_zip_path = local_file_path
+            local_tile_path = local_file_path
             file_exists = os.path.exists(local_file_path)
-            file_complete = None
-            # if file exists, but is incomplete, remove file and redownload
+            # if file exists, but is incomplete or corrupted, resume or redownload
             if file_exists:
-                existing_local_file_size = os.path.getsize(local_file_path)
                 # if local file is incomplete
-                if abs(existing_local_file_size - TNM_file_size) > size_diff_tolerance:
-                    # add file to cleanup list
-                    cleanup_list.append(local_file_path)
+                if not manifest.file_valid(TNM_file_URL, local_file_path, TNM_file_size):
+                    incomplete_count += 1
                     # NLCD API query returns subsets that cannot be filtered before
                     # results are returned. gui_subset is used to filter results.
                     if not gui_subset:
@@ -399,17 +2598,29 @@ def main():
     # return fatal error if API query returns no results for GUI input
     elif tile_API_count == 0:
         gscript.fatal(_("TNM API ERROR or Zero tiles available for given input parameters."))
+    profile.end('query', query_start)
+
+    if outside_count:
+        gscript.verbose(_("{0} tile(s) not intersecting the computational region or mask skipped").format(
+            outside_count))
+        if tiles_needed_count == 0 and not covered_count:
+            gscript.fatal(_("No tiles intersect the computational region or mask."))
+    if covered_count:
+        gscript.message(_("\n{0} tile(s) covered by existing raster <{1}> will be skipped.").format(
+            covered_count, gui_output_layer))
+        if tiles_needed_count == 0:
+            gscript.message(_("Raster <{0}> already covers the computational region.").format(
+                gui_output_layer))
+            return
 
     # number of files to be downloaded
     file_download_count = len(dwnld_url)
 
     # remove existing files from download lists
-    for t in exist_TNM_titles:
-        if t in TNM_file_titles:
-            TNM_file_titles.remove(t)
-    for url in exist_dwnld_url:
-        if url in dwnld_url:
-            dwnld_url.remove(url)
+    exist_TNM_titles_set = set(exist_TNM_titles)
+    TNM_file_titles = [t for t in TNM_file_titles if t not in exist_TNM_titles_set]
+    exist_dwnld_url_set = set(exist_dwnld_url)
+    dwnld_url = [url for url in dwnld_url if url not in exist_dwnld_url_set]
 
     # messages to user about status of files to be kept, removed, or downloaded
     if exist_zip_list:
@@ -418,20 +2629,16 @@ def main():
     if exist_tile_list:
         exist_msg = _("\n{0} of {1} files/archive(s) exist locally and will be used by module.").format(len(exist_tile_list), tiles_needed_count)
         gscript.message(exist_msg)
-    if cleanup_list:
-        cleanup_msg = _("\n{0} existing incomplete file(s) detected and removed. Run module again.").format(len(cleanup_list))
-        gscript.fatal(cleanup_msg)
+    if incomplete_count:
+        incomplete_msg = _("\n{0} existing incomplete file(s) detected and will be downloaded again or resumed.").format(incomplete_count)
+        gscript.message(incomplete_msg)
+    if reused_tiles:
+        gscript.message(_("\n{0} of {1} tile(s) imported by previous run will be reused.").format(
+            len(reused_tiles), tiles_needed_count))
 
     # formats JSON size from bites into needed units for combined file size
     if dwnld_size:
-        total_size = sum(dwnld_size)
-        len_total_size = len(str(total_size))
-        if 6 < len_total_size < 10:
-            total_size_float = total_size * 1e-6
-            total_size_str = str("{0:.2f}".format(total_size_float) + " MB")
-        if len_total_size >= 10:
-            total_size_float = total_size * 1e-9
-            total_size_str = str("{0:.2f}".format(total_size_float) + " GB")
+        total_size_str = size_str(sum(dwnld_size))
     else:
         total_size_str = '0'
 
@@ -450,7 +2657,7 @@ def main():
                     nlcd_unavailable = "NLCD {0} data unavailable for input parameters".format(gui_subset)
                     gscript.fatal(nlcd_unavailable)
     else:
-        data_info = (
+        data_info = [
                      "USGS file(s) to download:",
                      "-------------------------",
                      "Total download size:\t{size}",
@@ -458,196 +2665,813 @@ def main():
                      "USGS SRS:\t{srs}",
                      "USGS tile titles:\n{tile}",
                      "-------------------------",
-                     )
+                     ]
+        saved_size = 0
+        if gui_product == 'ned' and ned_auto and resolution_index is not None:
+            # size of the finest dataset estimated from number of cells,
+            # datasets have exact resolutions only in arc-seconds
+            finest = min(nav_string['dataset'].items(), key=lambda item: item[1][0])
+            scale = nav_string['dataset'][gui_dataset][0] / finest[1][0]
+            saved_size = int(round(sum(dwnld_size) * (scale * scale - 1)))
+        if saved_size:
+            data_info[5:5] = ["NED dataset:\t{dataset} (auto)",
+                              "Estimated size saved:\t{saved} (compared to {finest})"]
         data_info = '\n'.join(data_info).format(size=total_size_str,
                                                 count=file_download_count,
                                                 srs=product_srs,
-                                                tile=TNM_file_titles_info)
-    print data_info
+                                                tile=TNM_file_titles_info,
+                                                dataset=gui_dataset,
+                                                saved=size_str(saved_size),
+                                                finest=finest[0] if saved_size else None)
+    # products are queried concurrently, write the whole report at once
+    sys.stdout.write(data_info + '\n')
 
     if gui_i_flag:
         gscript.info(_("To download USGS data, remove <i> flag, and rerun r.in.usgs."))
-        sys.exit()
+        return
+
+    if gui_c_flag and file_download_count > 0:
+        gscript.fatal(_("{0} file(s) not available locally and cannot be downloaded in offline mode. Run module without <c> flag.").format(file_download_count))
 
     # USGS data download process
     if file_download_count <= 0:
-        gscript.message(_("Extracting existing USGS Data..."))
+        if len(reused_tiles) < tiles_needed_count:
+            gscript.message(_("Extracting existing USGS Data..."))
     else:
         gscript.message(_("Downloading USGS Data..."))
 
-    TNM_count = len(dwnld_url)
-    download_count = 0
-    local_tile_path_list = []
-    local_zip_path_list = []
-    patch_names = []
+    if tile_cache:
+        # files used in this run are not evicted
+        for local_file_path in exist_zip_list + exist_tile_list:
+            tile_cache.acquire(local_file_path)
 
-    # Download files
+    # files to be downloaded followed by files available locally,
+    # 'path' is the downloaded file, 'tile' the file to be imported
+    tiles = []
     for url in dwnld_url:
-        # create file name by splitting name from returned url
-        # add file name to local download directory
-        if gui_product == 'ned':
-            file_name = ned_data_abbrv + url.split(product_url_split)[-1]
-            local_file_path = os.path.join(work_dir, file_name)
-        else:
-            file_name = url.split(product_url_split)[-1]
-            local_file_path = os.path.join(work_dir, file_name)
-        try:
-            # download files in chunks rather than write complete files to memory
-            dwnld_req = urllib2.urlopen(url, timeout=12)
-            download_bytes = int(dwnld_req.info()['Content-Length'])
-            CHUNK = 16 * 1024
-            with open(local_file_path, "wb+") as local_file:
-                count = 0
-                steps = int(download_bytes / CHUNK) + 1
-                while True:
-                    chunk = dwnld_req.read(CHUNK)
-                    gscript.percent(count, steps, 10)
-                    count += 1
-                    if not chunk:
-                        break
-                    local_file.write(chunk)
-            local_file.close()
-            download_count += 1
-            # determine if file is a zip archive or another format
-            if product_is_zip:
-                local_zip_path_list.append(local_file_path)
-            else:
-                local_tile_path_list.append(local_file_path)
-            file_complete = "Download {0} of {1}: COMPLETE".format(
-                    download_count, TNM_count)
-            gscript.info(file_complete)
-        except urllib2.URLError:
-            gscript.fatal(_("USGS download request has timed out. Network or formatting error."))
-        except StandardError:
-            cleanup_list.append(local_file_path)
-            if download_count:
-                file_failed = "Download {0} of {1}: FAILED".format(
-                            download_count, TNM_count)
-                gscript.fatal(file_failed)
-
-    # sets already downloaded zip files or tiles to be extracted or imported
-    if exist_zip_list:
-        for z in exist_zip_list:
-            local_zip_path_list.append(z)
-    if exist_tile_list:
-        for t in exist_tile_list:
-            local_tile_path_list.append(t)
-    if product_is_zip:
-        if file_download_count == 0:
-            pass
+        tiles.append({'url': url, 'size': dwnld_url_size[url], 'download': True,
+                      'path': local_path(url, dwnld_url_size[url]),
+                      'bbox': TNM_url_bboxes.get(url)})
+    for url, local_file_path in zip(exist_dwnld_url, exist_zip_list + exist_tile_list):
+        tiles.append({'url': url, 'size': TNM_url_sizes[url], 'download': False,
+                      'path': local_file_path, 'bbox': TNM_url_bboxes.get(url)})
+    scratch_space = shared['scratch_space']
+
+    def download_stage(tile):
+        if tile['download']:
+            # files in the shared cache are not in the scratch space
+            if scratch_space and not (tile_cache and tile_cache.contains(tile['path'])):
+                scratch_space.reserve(tile['size'])
+                tile['scratch'] = tile['size']
+            progress = shared['progress']
+            def download_attempt():
+                file_progress = FileProgress(progress)
+                try:
+                    download_tile(tile['url'], tile['path'], tile['size'],
+                                  file_progress, tile_cache, manifest)
+                except Exception:
+                    file_progress.rollback()
+                    raise
+                tile['transferred'] = file_progress.done_bytes
+            retry(download_attempt, retries, retry_time,
+                  "Download of {0}".format(tile['url']))
+            manifest.update(tile['url'], title=TNM_url_titles[tile['url']])
+            progress.file_completed()
+        return tile
+
+    def extract_stage(tile):
+        if not product_is_zip:
+            tile['tile'] = tile['path']
+            return tile
+        # extract needed file from zip archive or read it directly,
+        # name of the file in archive is known from previous runs
+        z = tile['path']
+        member = (manifest.get(tile['url']) or {}).get('zip_member')
+        if not member:
+            member = find_zip_member(z, product_extension)
+            if member is None:
+                raise IOError(z)
+            manifest.update(tile['url'], zip_member=member)
+        if not gui_e_flag:
+            tile['tile'] = vsizip_path(z, member)
+            tile['zip_member'] = (z, member)
         else:
-            gscript.message("Extracting data...")
-        # for each zip archive, extract needed file
-        for z in local_zip_path_list:
-            # Extract tiles from ZIP archives
+            tile['tile'] = os.path.join(work_dir, member)
+            # linked files are read in place
+            if not (gui_k_flag or gui_l_flag):
+                cleanup_list.append(tile['tile'])
+            extract(z, member)
+            reserve_extracted(tile)
+            manifest.update(tile['url'], extracted=tile['tile'])
+        return tile
+
+    def reserve_extracted(tile):
+        if scratch_space:
+            nbytes = os.path.getsize(tile['tile'])
+            scratch_space.reserve(nbytes, wait=False)
+            tile['scratch'] = tile.get('scratch', 0) + nbytes
+
+    extract_pool = shared['extract_pool']
+
+    def extract(zip_path, member):
+        if extract_pool:
+            return extract_pool.apply(extract_zip_member, (zip_path, member, work_dir))
+        return extract_zip_member(zip_path, member, work_dir)
+
+    worker_mapsets = shared['worker_mapsets']
+
+    def import_tile(tile):
+        if nprocs > 1 and not gui_m_flag:
+            mapset, env = worker_mapsets.get()
             try:
-                with zipfile.ZipFile(z, "r") as read_zip:
-                    for f in read_zip.namelist():
-                        if f.endswith(product_extension):
-                            extracted_tile = os.path.join(work_dir, str(f))
-                            if os.path.exists(extracted_tile):
-                                os.remove(extracted_tile)
-                                read_zip.extract(f, work_dir)
-                            else:
-                                read_zip.extract(f, work_dir)
-                if os.path.exists(extracted_tile):
-                    local_tile_path_list.append(extracted_tile)
-                    cleanup_list.append(extracted_tile)
-            except:
-                cleanup_list.append(extracted_tile)
-                gscript.fatal(_("Unable to locate or extract IMG file from ZIP archive."))
-
-    # operations for extracted or complete files available locally
-    for t in local_tile_path_list:
+                return import_tile_into(tile, mapset, env)
+            finally:
+                worker_mapsets.put((mapset, env))
+        return import_tile_into(tile, None, None)
+
+    def import_tile_into(tile, mapset, env):
         # create variables for use in GRASS GIS import process
+        t = tile['tile']
         LT_file_name = os.path.basename(t)
         LT_layer_name = os.path.splitext(LT_file_name)[0]
-        patch_names.append(LT_layer_name)
+        # reuse tile imported in previous run from the same source
+        # with the same parameters
+        if gui_r_flag:
+            tag = tile_source_tag(tile['url'], tile['size'], product_resolution,
+                                  product_interpolation)
+            if gui_product == 'naip':
+                names = [band_name(LT_layer_name, i) for i in ('1', '2', '3', '4')]
+            else:
+                names = [LT_layer_name]
+            if all(tile_raster_matches(name, tag) for name in names):
+                gscript.info(_("Using previously imported {0}").format(LT_layer_name))
+                tile['layer'] = LT_layer_name
+                manifest.update(tile['url'], imported=LT_layer_name)
+                remove_source(tile)
+                return tile
         in_info = ("Importing and reprojecting {0}...").format(LT_file_name)
         gscript.info(in_info)
-        # import to GRASS GIS
+        # import to GRASS GIS, tiles for reuse are imported whole,
+        # so that they can be used with any region
+        import_extent = 'input' if gui_r_flag else 'region'
         try:
-            gscript.run_command('r.import', input=t, output=LT_layer_name,
-                                resolution='value', resolution_value=product_resolution,
-                                extent="region", resample=product_interpolation)
-            # do not remove by default with NAIP, there are no zip files
-            if gui_product != 'naip' or not gui_k_flag:
+            run_module('r.import', input=t, output=LT_layer_name,
+                       resolution='value', resolution_value=product_resolution,
+                       extent=import_extent, resample=product_interpolation,
+                       overwrite=gui_r_flag, env=env)
+        except CalledModuleError:
+            if not tile.get('zip_member'):
+                raise
+            # GDAL driver may not support reading from archive,
+            # extract the file and import it instead
+            z, member = tile.pop('zip_member')
+            gscript.warning(_("Unable to read '{0}' directly from archive, extracting it").format(
+                LT_file_name))
+            t = tile['tile'] = extract(z, member)
+            reserve_extracted(tile)
+            if not gui_k_flag:
+                cleanup_list.append(t)
+            run_module('r.import', input=t, output=LT_layer_name,
+                       resolution='value', resolution_value=product_resolution,
+                       extent=import_extent, resample=product_interpolation,
+                       overwrite=gui_r_flag, env=env)
+        if gui_r_flag:
+            for name in names:
+                run_module('r.support', map=name, source1=tile['url'],
+                           source2=tag, env=env)
+        if mapset:
+            LT_layer_name += '@' + mapset
+        tile['layer'] = LT_layer_name
+        manifest.update(tile['url'], imported=LT_layer_name)
+        remove_source(tile)
+        return tile
+
+    def remove_source(tile):
+        # keep extracted files (NAIP tiles are not extracted) with 'k' flag,
+        # never remove files from the shared cache
+        t = tile['tile']
+        if not (tile.get('zip_member') or gui_k_flag):
+            if not (tile_cache and tile_cache.contains(t)):
                 cleanup_list.append(t)
+        if scratch_space:
+            free_scratch_space(tile)
+
+    def free_scratch_space(tile):
+        # with limited scratch space, extracted files and files downloaded
+        # in this run are removed right after import
+        paths = []
+        if product_is_zip and not tile.get('zip_member'):
+            paths.append(tile['tile'])
+        if tile['download'] and not (tile_cache and tile_cache.contains(tile['path'])):
+            paths.append(tile['path'])
+        for path in paths:
+            if os.path.exists(path):
+                gscript.try_remove(path)
+        scratch_space.release(tile.pop('scratch', 0))
+
+    def scratch_stage(function):
+        # space reserved for a failed tile is released,
+        # its files are kept, so that the download can be resumed
+        def stage(tile):
+            try:
+                return function(tile)
+            except Exception:
+                if scratch_space:
+                    scratch_space.release(tile.pop('scratch', 0))
+                raise
+        return stage
+
+    def link_output(tiles):
+        # GDAL reads the linked files in place, so they are kept,
+        # entries of the shared cache are pinned, so that they are
+        # not evicted in later runs
+        sources = []
+        for tile in tiles:
+            if tile.get('zip_member'):
+                sources.append(vsizip_path(*tile['zip_member']))
+            else:
+                sources.append(os.path.abspath(tile['tile']))
+        vrt_path = os.path.abspath(os.path.join(work_dir, gui_output_layer + '.vrt'))
+        if gui_w_flag:
+            if not location_srs:
+                gscript.fatal(_("Unknown coordinate reference system of the location, "
+                                "unable to reproject linked tiles"))
+            gscript.info(_("Building warped VRT of {0} tiles...").format(len(sources)))
+            bounds = (gregion['w'], gregion['s'], gregion['e'], gregion['n'])
+            if not build_warped_vrt(vrt_path, sources, location_srs, bounds, product_resolution,
+                                    gdal_resampling(product_interpolation)):
+                gscript.fatal(_("Unable to build warped VRT '{0}'").format(vrt_path))
+            sources = [vrt_path]
+        elif len(sources) > 1 and gdal and build_vrt(vrt_path, sources):
+            sources = [vrt_path]
+        gscript.info(_("Linking {0}...").format(", ".join(os.path.basename(source)
+                                                          for source in sources)))
+        try:
+            if len(sources) == 1:
+                run_module('r.external', input=sources[0], output=gui_output_layer)
+                names = [gui_output_layer] * len(tiles)
+            else:
+                # without VRT mosaic, tiles are linked one by one
+                # and combined into a GRASS virtual raster
+                names = []
+                for source in sources:
+                    name = os.path.splitext(os.path.basename(source))[0]
+                    run_module('r.external', input=source, output=name)
+                    names.append(name)
+                if gui_product == 'naip':
+                    bands = [(band_name(gui_output_layer, i), [band_name(name, i) for name in names])
+                             for i in ('1', '2', '3', '4')]
+                else:
+                    bands = [(gui_output_layer, names)]
+                for output, inputs in bands:
+                    run_module('r.buildvrt', input=inputs, output=output)
         except CalledModuleError:
-            in_error = ("Unable to import '{0}'").format(LT_file_name)
-            gscript.fatal(in_error)
+            gscript.fatal(_("Unable to link tiles. Tiles in coordinate reference system "
+                            "different from the location can be linked with <w> flag."))
+        if tile_cache:
+            # pins record the raster linking the file (first band of NAIP)
+            gisenv = gscript.gisenv()
+            mapset_path = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'],
+                                       gisenv['MAPSET'])
+            for tile, name in zip(tiles, names):
+                if tile_cache.contains(tile['path']):
+                    if gui_product == 'naip':
+                        name = band_name(name, '1')
+                    tile_cache.pin(tile['path'], mapset_path, name)
+
+    # Tiles are downloaded, extracted and imported by the caller
+    # in a pipeline shared by all products, with a mosaic, tiles
+    # are imported together afterwards, linked tiles are not imported
+    stages = {
+        'download': profile.tile_stage(
+            'download', scratch_stage(download_stage),
+            nbytes=lambda tile: tile.get('transferred', 0)),
+        'extract': profile.tile_stage(
+            'extract', scratch_stage(extract_stage),
+            nbytes=lambda tile: os.path.getsize(tile['tile']) if product_is_zip and gui_e_flag else None),
+        'import': profile.tile_stage('import', scratch_stage(import_tile)),
+        }
+    for tile in tiles:
+        tile['stages'] = stages
+    processed_tiles, errors = yield tiles
+
+    # summary of failed tiles, partial files are kept,
+    # so that the download can be resumed when the module is run again
+    failed_count = len(errors)
+    if errors:
+        failed_info = []
+        for stage, tile, error in errors:
+            title = TNM_url_titles.get(tile['url'], tile['url'])
+            if stage == 'download':
+                failed_info.append("{0}: download failed ({1})".format(title, error))
+            elif stage == 'extract':
+                failed_info.append("{0}: unable to locate or extract file from ZIP archive ({1})".format(
+                    title, error))
+            else:
+                failed_info.append("{0}: unable to import '{1}'".format(
+                    title, os.path.basename(tile['tile'])))
+        gscript.warning(_("{0} of {1} tile(s) failed:\n{2}").format(
+            failed_count, len(tiles), "\n".join(failed_info)))
+    processed_tiles = [tile for tile in processed_tiles if tile] + reused_tiles
+    if not processed_tiles:
+        gscript.fatal("Error downloading files. Please retry.")
+    local_tile_path_list = [tile['tile'] for tile in processed_tiles]
+
+    # link tiles instead of importing them, patching is not needed
+    if gui_l_flag:
+        with profile.stage('link'):
+            link_output(processed_tiles)
+
+    # import all tiles at once as a VRT mosaic, so that the reprojection
+    # and resampling is done once and without seams between tiles
+    mosaic_imported = False
+    if gui_m_flag and len(local_tile_path_list) > 1:
+        vrt_path = os.path.join(work_dir, gui_output_layer + '.vrt')
+        if build_vrt(vrt_path, local_tile_path_list):
+            cleanup_list.append(vrt_path)
+            gscript.info(_("Importing and reprojecting mosaic of {0} tiles...").format(
+                len(local_tile_path_list)))
+            try:
+                with profile.stage('import'):
+                    run_module('r.import', input=vrt_path, output=gui_output_layer,
+                               resolution='value', resolution_value=product_resolution,
+                               extent="region", resample=product_interpolation)
+            except CalledModuleError:
+                gscript.fatal(_("Unable to import mosaic '{0}'").format(vrt_path))
+            mosaic_imported = True
+            for tile in processed_tiles:
+                remove_source(tile)
+        else:
+            gscript.warning(_("Unable to build mosaic, tiles cannot be read by GDAL or differ in "
+                              "coordinate reference system or number of bands. "
+                              "Importing tiles one by one."))
+    if gui_m_flag and not mosaic_imported:
+        for tile in processed_tiles:
+            try:
+                profile.tile_stage('import', import_tile)(tile)
+            except CalledModuleError:
+                in_error = ("Unable to import '{0}'").format(os.path.basename(tile['tile']))
+                gscript.fatal(in_error)
+    local_tile_path_list = [tile['tile'] for tile in processed_tiles]
+    patch_names = [tile['layer'] for tile in processed_tiles if 'layer' in tile]
 
     # if control variables match and multiple files need to be patched,
     # check product resolution, run r.patch
 
-    # Check that downloaded files match expected count
+    def patch_output(inputs, output):
+        if len(inputs) > 1:
+            run_module('r.patch', input=inputs, output=output)
+        else:
+            run_module('r.mapcalc', expression='"{0}" = "{1}"'.format(output, inputs[0]))
+
+    def grow_outputs(outputs, composite=None):
+        # existing outputs are not rewritten, for each rectangle of the
+        # added area a part is patched from the new tiles and the parts
+        # are combined into a virtual raster, so the cost depends only
+        # on the added area; outputs maps output names to patched tiles,
+        # composite of the parts is created for each rectangle as well
+        run_module('g.region', n=gregion['n'], s=gregion['s'], e=gregion['e'],
+                   w=gregion['w'], align=existing_map)
+        rectangles = extent_difference(gscript.region(), existing_extents)
+        if not rectangles:
+            gscript.verbose(_("Raster <{0}> already covers the computational region").format(
+                existing_map))
+            return
+        names = [name for name, inputs in outputs]
+        if composite:
+            names.append(gui_output_layer)
+        parts = {}
+        for name in names:
+            parts[name] = virtual_raster_inputs(name)
+            if parts[name] is None:
+                part = unused_part_name(name, [])
+                run_module('g.rename', raster=(name, part))
+                parts[name] = [part]
+
+        # bands are patched concurrently
+        def patch_part(output):
+            name, inputs = output
+            patch_output(inputs, parts[name][-1])
+            return name
+
+        for rectangle in rectangles:
+            # rectangle edges are on the grid of the existing output
+            run_module('g.region', n=rectangle['n'], s=rectangle['s'],
+                       e=rectangle['e'], w=rectangle['w'], align=existing_map)
+            for name in names:
+                parts[name].append(unused_part_name(name, parts[name]))
+            part_pipeline = Pipeline()
+            part_pipeline.add_stage('patch', patch_part, 4)
+            part_pipeline.run(outputs)
+            if part_pipeline.errors:
+                raise part_pipeline.errors[0][2]
+            if composite:
+                run_module('r.composite', output=parts[gui_output_layer][-1],
+                           **dict((color, parts[name][-1]) for color, name in composite))
+        for name in names:
+            run_module('r.buildvrt', input=parts[name], output=name, overwrite=True)
+        if composite:
+            run_module('r.colors', map=gui_output_layer, raster=parts[gui_output_layer][-1])
+
+    def unused_part_name(name, parts):
+        index = len(parts)
+        while True:
+            part = '{0}_part{1}'.format(name, index)
+            if not gscript.find_file(part, element='cell', mapset='.')['file']:
+                return part
+            index += 1
+
+    def update_outputs():
+        # patch new tiles into the area added to existing output,
+        # the existing map is the first part and its grid is kept
+        if gui_product != 'naip':
+            grow_outputs([(gui_output_layer, patch_names)])
+            return
+        outputs = [(band_name(gui_output_layer, i), [band_name(name, i) for name in patch_names])
+                   for i in ('1', '2', '3', '4')]
+        composite = None
+        if gui_naip_composite == 'rgb' and composite_exists:
+            composite = zip(('red', 'green', 'blue'), [name for name, inputs in outputs])
+        grow_outputs(outputs, composite)
+
+    def patch_aoi(aoi):
+        # patch tiles intersecting area of interest within its extent,
+        # vector areas are clipped by their raster, so that MASK
+        # of the user is kept and applies as well
+        output = '{0}_{1}'.format(gui_output_layer, aoi['name'])
+        names = [tile['layer'] for tile in processed_tiles
+                 if not tile.get('bbox') or aoi['index'].intersects(tile['bbox'])]
+        if not names:
+            gscript.warning(_("No data for area of interest <{0}>").format(aoi['name']))
+            return
+        region = aoi['region']
+        run_module('g.region', n=region['n'], s=region['s'],
+                   e=region['e'], w=region['w'])
+        if product_resolution:
+            run_module('g.region', res=product_resolution, flags='a')
+        if gui_product == 'naip':
+            bands = [(band_name(output, i), [band_name(name, i) for name in names])
+                     for i in ('1', '2', '3', '4')]
+        else:
+            bands = [(output, names)]
+        if aoi['cat'] is None:
+            for band_output, inputs in bands:
+                patch_output(inputs, band_output)
+        else:
+            area = 'tmp_r_in_usgs_{0}_area'.format(os.getpid())
+            patched = 'tmp_r_in_usgs_{0}_patched'.format(os.getpid())
+            temp_maps = [area]
+            try:
+                run_module('v.to.rast', input=gui_aoi, cats=aoi['cat'], output=area,
+                           use='val', overwrite=True)
+                for band_output, inputs in bands:
+                    source = inputs[0]
+                    if len(inputs) > 1:
+                        run_module('r.patch', input=inputs, output=patched, overwrite=True)
+                        temp_maps.append(patched)
+                        source = patched
+                    run_module('r.mapcalc', expression='"{0}" = if(isnull("{1}"), null(), "{2}")'.format(
+                        band_output, area, source))
+            finally:
+                run_module('g.remove', type='raster', name=sorted(set(temp_maps)), flags='f')
+        if gui_product == 'ned':
+            run_module('r.colors', map=output, color='elevation')
+        elif gui_product == 'naip' and gui_naip_composite == 'rgb':
+            run_module('r.composite', red=bands[0][0], green=bands[1][0],
+                       blue=bands[2][0], output=output)
+        elif gui_product == 'naip' and gui_naip_composite == 'group':
+            run_module('i.group', group=output, input=[band[0] for band in bands])
+        gscript.verbose(_("Layer '{0}' added").format(output))
+
+    def tiles_to_remove():
+        # Remove tiles unless 'k' or 'r' flag, rasters in temporary
+        # mapsets are removed with the mapsets
+        if gui_k_flag or gui_r_flag:
+            for name in patch_names:
+                keep_tile(name)
+            return []
+        remove_names = [name for name in patch_names if '@' not in name]
+        if gui_product == 'naip':
+            remove_names = [band_name(name, i) for name in remove_names
+                            for i in ('1', '2', '3', '4')]
+        return remove_names
+
+    def keep_tile(name):
+        # keep imported tile in the current mapset
+        if '@' not in name:
+            return
+        if gui_product == 'naip':
+            for i in ('1', '2', '3', '4'):
+                run_module('g.copy', raster=(band_name(name, i),
+                                             band_name(name.split('@')[0], i)),
+                           overwrite=gui_r_flag)
+        else:
+            run_module('g.copy', raster=(name, name.split('@')[0]),
+                       overwrite=gui_r_flag)
+
+    # Check that downloaded files match expected count,
+    # patching includes creation of NAIP composite below
+    patch_start = profile.begin('patch')
     completed_tiles_count = len(local_tile_path_list)
-    if completed_tiles_count == tiles_needed_count:
-        if completed_tiles_count > 1:
+    remove_names = []
+    if completed_tiles_count + failed_count == tiles_needed_count:
+        if mosaic_imported:
+            out_info = ("Mosaic layer '{0}' added").format(gui_output_layer)
+            gscript.verbose(out_info)
+        elif gui_l_flag:
+            out_info = ("Linked layer '{0}' added").format(gui_output_layer)
+            gscript.verbose(out_info)
+        elif aois:
+            try:
+                for aoi in aois:
+                    patch_aoi(aoi)
+            except CalledModuleError:
+                gscript.fatal("Unable to patch tiles.")
+            remove_names = tiles_to_remove()
+            gscript.info(_("Outputs for {0} areas of interest created").format(len(aois)))
+        elif completed_tiles_count > 1 or existing_info:
             try:
                 gscript.use_temp_region()
                 # set the resolution
                 if product_resolution:
-                    gscript.run_command('g.region', res=product_resolution, flags='a')
-                if gui_product == 'naip':
-                    for i in ('1', '2', '3', '4'):
-                        patch_names_i = [name + '.' + i for name in patch_names]
-                        gscript.run_command('r.patch', input=patch_names_i,
-                                            output=gui_output_layer + '.' + i)
+                    run_module('g.region', res=product_resolution, flags='a')
+                if existing_info:
+                    update_outputs()
+                elif gui_product == 'naip':
+                    # bands are patched concurrently
+                    def patch_band(i):
+                        patch_names_i = [band_name(name, i) for name in patch_names]
+                        patch_output(patch_names_i, gui_output_layer + '.' + i)
+                        return i
+                    band_pipeline = Pipeline()
+                    band_pipeline.add_stage('patch', patch_band, 4)
+                    band_pipeline.run(['1', '2', '3', '4'])
+                    if band_pipeline.errors:
+                        raise band_pipeline.errors[0][2]
                 else:
-                    gscript.run_command('r.patch', input=patch_names,
-                                        output=gui_output_layer)
+                    patch_output(patch_names, gui_output_layer)
                 gscript.del_temp_region()
                 out_info = ("Patched composite layer '{0}' added").format(gui_output_layer)
                 gscript.verbose(out_info)
-                # Remove files if 'k' flag
-                if not gui_k_flag:
-                    if gui_product == 'naip':
-                        for i in ('1', '2', '3', '4'):
-                            patch_names_i = [name + '.' + i for name in patch_names]
-                            gscript.run_command('g.remove', type='raster',
-                                                name=patch_names_i, flags='f')
-                    else:
-                        gscript.run_command('g.remove', type='raster',
-                                            name=patch_names, flags='f')
+                # removal runs while NAIP composite is created
+                remove_names = tiles_to_remove()
             except CalledModuleError:
                 gscript.fatal("Unable to patch tiles.")
         elif completed_tiles_count == 1:
+            # raster in a temporary mapset cannot be renamed,
+            # tile for reuse is kept
+            if gui_k_flag or gui_r_flag:
+                keep_tile(patch_names[0])
+            rename = 'g.copy' if '@' in patch_names[0] or gui_r_flag else 'g.rename'
             if gui_product == 'naip':
                 for i in ('1', '2', '3', '4'):
-                    gscript.run_command('g.rename', raster=(patch_names[0] + '.' + i, gui_output_layer + '.' + i))
+                    run_module(rename, raster=(band_name(patch_names[0], i), gui_output_layer + '.' + i))
             else:
-                gscript.run_command('g.rename', raster=(patch_names[0], gui_output_layer))
-        temp_down_count = "\n{0} of {1} tile/s succesfully imported and patched.".format(completed_tiles_count,
-                                                                                         tiles_needed_count)
+                run_module(rename, raster=(patch_names[0], gui_output_layer))
+        if gui_l_flag:
+            temp_down_count = "\n{0} of {1} tile/s succesfully linked.".format(completed_tiles_count,
+                                                                               tiles_needed_count)
+        else:
+            temp_down_count = "\n{0} of {1} tile/s succesfully imported and patched.".format(completed_tiles_count,
+                                                                                             tiles_needed_count)
         gscript.info(temp_down_count)
     else:
         gscript.fatal("Error downloading files. Please retry.")
 
+    # composite NAIP in background
+    naip_bands = [gui_output_layer + '.' + i for i in ('1', '2', '3', '4')]
+    composite = None
+    # composite extended with the bands is not created again
+    if (gui_product == 'naip' and gui_naip_composite == 'rgb' and not aois and
+            not (existing_info and composite_exists)):
+        gscript.use_temp_region()
+        run_module('g.region', raster=naip_bands[0])
+        composite_start = time.time()
+        composite = gscript.start_command('r.composite', red=naip_bands[0],
+                                          green=naip_bands[1], blue=naip_bands[2],
+                                          output=gui_output_layer)
+
+    # remove imported tiles
+    if remove_names:
+        try:
+            run_module('g.remove', type='raster', name=remove_names, flags='f')
+        except CalledModuleError:
+            gscript.warning(_("Unable to remove imported tiles"))
+
     # Keep source files if 'k' flag active
     if gui_k_flag:
         src_msg = ("<k> flag selected: Source tiles remain in '{0}'").format(work_dir)
         gscript.info(src_msg)
 
     # set appropriate color table
-    if gui_product == 'ned':
-        gscript.run_command('r.colors', map=gui_output_layer, color='elevation')
+    if gui_product == 'ned' and not aois:
+        run_module('r.colors', map=gui_output_layer, color='elevation')
 
-    # composite NAIP
-    if gui_product == 'naip':
-        gscript.use_temp_region()
-        gscript.run_command('g.region', raster=gui_output_layer + '.1')
-        gscript.run_command('r.composite', red=gui_output_layer + '.1',
-                            green=gui_output_layer + '.2', blue=gui_output_layer + '.3',
-                            output=gui_output_layer)
+    if composite:
+        returncode = profile.wait('r.composite', composite, composite_start)
         gscript.del_temp_region()
+        if returncode:
+            gscript.fatal(_("Unable to create RGB composite <{0}>").format(gui_output_layer))
+    elif gui_product == 'naip' and gui_naip_composite == 'group' and not aois:
+        run_module('i.group', group=gui_output_layer, input=naip_bands)
+    profile.end('patch', patch_start)
+
+
+def product_jobs(options):
+    """Return options for each combination of product, dataset and subset
+
+    Products, NED datasets and NLCD subsets can be given as lists.
+    With more than one combination, output names get suffixes
+    with the product, dataset and subset where more of them are given.
+    NED dataset auto is left out when it selects a dataset given as well.
+    """
+    def values(key):
+        unique = []
+        for value in options[key].split(','):
+            if value not in unique:
+                unique.append(value)
+        return unique
+
+    products = values('product')
+    ned_datasets = values('ned_dataset')
+    nlcd_subsets = values('nlcd_subset')
+    # output names do not depend on the region
+    ned_suffix = len(ned_datasets) > 1
+    if 'ned' in products and 'auto' in ned_datasets and ned_suffix:
+        # dataset selected for region resolution is imported only once,
+        # otherwise two jobs would download the same files concurrently
+        resolution_index = location_resolution_index(get_location_srs())
+        if resolution_index is None:
+            auto_dataset = 'ned1sec'
+        else:
+            region = gscript.region()
+            auto_dataset = auto_ned_dataset(min(region['nsres'], region['ewres']),
+                                            resolution_index)
+        if auto_dataset in ned_datasets:
+            gscript.message(_("NED dataset <{0}> selected for resolution of the computational region "
+                              "is already requested").format(auto_dataset))
+            ned_datasets.remove('auto')
+    jobs = []
+    for product in products:
+        if product == 'ned':
+            variants = [{'ned_dataset': dataset} for dataset in ned_datasets]
+        elif product == 'nlcd':
+            variants = [{'nlcd_subset': subset} for subset in nlcd_subsets]
+        else:
+            variants = [{}]
+        for variant in variants:
+            job = dict(options)
+            job.update(variant)
+            job['product'] = product
+            suffix = [product] if len(products) > 1 else []
+            if len(variants) > 1 or (product == 'ned' and ned_suffix):
+                suffix += variant.values()
+            if suffix:
+                job['output_name'] = '_'.join([options['output_name']] + suffix)
+            jobs.append(job)
+    return jobs
+
+
+def main():
+    if options['profile']:
+        profile.enable(options['profile'], python_profile=flags['p'])
+        profile.info.update(product=options['product'], options=options, flags=flags)
+    jobs = product_jobs(options)
+    if len(jobs) > 1 and not flags['i']:
+        gscript.message(_("Importing {0} products into <{1}>").format(
+            len(jobs), ">, <".join(job['output_name'] for job in jobs)))
+
+    # resources shared by all products
+    shared = {'tile_cache': None, 'aois': None, 'scratch_space': None,
+              'extract_pool': None, 'worker_mapsets': Queue.Queue()}
+    work_dir = options['output_directory']
+    nprocs = int(options['nprocs'])
+    if options['cache_directory']:
+        shared['tile_cache'] = TileCache(options['cache_directory'],
+                                         int(options['cache_size']) * 1024 * 1024)
+        cleanup_caches.append(shared['tile_cache'])
+
+    # index of local files in the output directory
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    shared['manifest'] = TileManifest(os.path.join(work_dir, '.tile_manifest.sqlite'))
+
+    # in batch mode, data are queried, downloaded and imported
+    # for the union of the areas of interest and one output
+    # is created for each of them
+    aois = None
+    if options['aoi']:
+        aois = read_aoi_vector(options['aoi'])
+    elif options['aoi_file']:
+        aois = read_aoi_file(options['aoi_file'])
+    if aois is not None:
+        if not aois:
+            gscript.fatal(_("No areas of interest found"))
+        gscript.use_temp_region()
+        run_module('g.region', n=max(aoi['region']['n'] for aoi in aois),
+                   s=min(aoi['region']['s'] for aoi in aois),
+                   e=max(aoi['region']['e'] for aoi in aois),
+                   w=min(aoi['region']['w'] for aoi in aois))
+    shared['aois'] = aois
+
+    if not flags['i']:
+        max_scratch_space = int(options['max_scratch_space'] or 0)
+        if max_scratch_space:
+            shared['scratch_space'] = ScratchSpace(max_scratch_space * 1024 * 1024)
+        # with e flag, archives are extracted in separate processes, zipfile
+        # decompresses and checks CRC mostly while holding the GIL,
+        # processes are started before any other thread; without it,
+        # tiles are read from the archives and the rare fallback
+        # extraction runs in the thread of the extract stage
+        if (flags['e'] and nprocs > 1 and
+                any(usgs_product_dict[job['product']]['zip'] for job in jobs)):
+            shared['extract_pool'] = multiprocessing.Pool(nprocs)
+        # with parallel import, each worker imports into its own mapset
+        if nprocs > 1 and not (flags['m'] or flags['l']):
+            for i in range(nprocs):
+                mapset = 'tmp_r_in_usgs_{0}_{1}'.format(os.getpid(), i)
+                shared['worker_mapsets'].put((mapset, create_temp_mapset(mapset)))
+
+    # TNM API is queried and tiles selected for all products concurrently,
+    # a product without tiles to process (or with i flag) is done
+    runs = [import_product(job, shared) for job in jobs]
+    exits = []
+
+    def start(run):
+        try:
+            return next(run)
+        except StopIteration:
+            return None
+        except SystemExit as error:
+            # fatal error, message was already printed
+            exits.append(error)
+            return None
+
+    query = Pipeline()
+    query.add_stage('query', start, len(runs))
+    run_tiles = query.run(runs)
+    if query.errors:
+        raise query.errors[0][2]
+    if exits:
+        sys.exit(exits[0].code)
+
+    # Download, extract and import tiles of all products in one pipeline,
+    # the stage functions are given by product in each tile,
+    # a failed tile does not stop processing of other tiles
+    tiles = []
+    for tiles_of_run in run_tiles:
+        tiles.extend(tiles_of_run or [])
+    # products with all tiles reused from previous run are only patched
+    if all(tiles_of_run is None for tiles_of_run in run_tiles):
+        return 0
+    download_tiles = [tile for tile in tiles if tile['download']]
+    shared['progress'] = DownloadProgress(sum(tile['size'] for tile in download_tiles),
+                                          len(download_tiles))
+    pipeline = Pipeline(stop_on_error=False)
+    pipeline.add_stage('download', lambda tile: tile['stages']['download'](tile),
+                       int(options['download_workers']))
+    pipeline.add_stage('extract', lambda tile: tile['stages']['extract'](tile),
+                       nprocs if flags['e'] else 1)
+    if not (flags['m'] or flags['l']):
+        pipeline.add_stage('import', lambda tile: tile['stages']['import'](tile), nprocs)
+    processed_tiles = pipeline.run(tiles) if tiles else []
+    if download_tiles:
+        gscript.percent(1, 1, 1)
+    if shared['tile_cache']:
+        shared['tile_cache'].evict()
+
+    # patch tiles of each product
+    start_index = 0
+    for run, tiles_of_run in zip(runs, run_tiles):
+        if tiles_of_run is None:
+            continue
+        end_index = start_index + len(tiles_of_run)
+        tile_ids = set(id(tile) for tile in tiles_of_run)
+        errors = [error for error in pipeline.errors if id(error[1]) in tile_ids]
+        try:
+            run.send((processed_tiles[start_index:end_index], errors))
+        except StopIteration:
+            pass
+        start_index = end_index
+    if shared['extract_pool']:
+        shared['extract_pool'].close()
+        shared['extract_pool'].join()
+    return 0
 
 
 def cleanup():
+    # Write profile of the run, also when it failed
+    profile.write()
     # Remove files in cleanup_list
     for f in cleanup_list:
         if os.path.exists(f):
             gscript.try_remove(f)
+    # Release locks of shared cache entries
+    for cache in cleanup_caches:
+        cache.release()
+    # Remove temporary mapsets
+    for d in cleanup_dirs:
+        shutil.rmtree(d, ignore_errors=True)
 
 
 if __name__ == "__main__":
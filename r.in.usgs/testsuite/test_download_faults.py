@@ -0,0 +1,176 @@
+"""
+Name:      test_download_faults
+Purpose:   Test handling of server errors during downloads of r.in.usgs
+
+License:   This program is free software under the GNU General Public
+           License (>=v2). Read the file COPYING that comes with GRASS
+           for details.
+"""
+
+import os
+import sys
+import imp
+import time
+import shutil
+import urllib2
+import tempfile
+
+import grass.script as gscript
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+from grass.gunittest.gmodules import SimpleModule
+
+from tile_server import TileServer
+
+testsuite_dir = os.path.dirname(os.path.abspath(__file__))
+module = imp.load_source('r_in_usgs', os.path.join(testsuite_dir, '..', 'r.in.usgs.py'))
+sys.path.append(os.path.join(testsuite_dir, '..', 'benchmark'))
+from mock_tnm import MockTNM, TNMHandler
+
+SIZE = 1024 * 1024
+BAD_ETAG = '"{0}"'.format('0' * 32)
+
+
+class TestDownloadRetry(TestCase):
+    """Downloads are retried on transient errors of the server"""
+
+    def setUp(self):
+        self.data = os.urandom(SIZE)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'tile.zip')
+        self.server = TileServer({'tile.zip': self.data}).start()
+
+    def tearDown(self):
+        module.close_connections()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def download(self, retries=3, retry_time=10):
+        progress = module.DownloadProgress(SIZE, 1)
+        module.retry(lambda: module.download_tile(self.server.url('tile.zip'), self.path,
+                                                  SIZE, progress),
+                     retries, retry_time, "Download", base_delay=0.1)
+
+    def assertDownloaded(self):
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        with open(self.path, 'rb') as tile:
+            self.assertTrue(tile.read() == self.data, msg="Downloaded data differ")
+
+    def test_retry_after(self):
+        """Retry-After of 503 response is waited for"""
+        self.server.faults['tile.zip'] = [
+            {'status': 503, 'headers': [('Retry-After', '1')]}]
+        start = time.time()
+        self.download()
+        self.assertGreaterEqual(time.time() - start, 1)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertDownloaded()
+
+    def test_retry_after_too_long(self):
+        """Retry-After longer than retry_time is not waited for"""
+        self.server.faults['tile.zip'] = [
+            {'status': 503, 'headers': [('Retry-After', '60')]}]
+        start = time.time()
+        with self.assertRaises(urllib2.HTTPError) as context:
+            self.download(retry_time=5)
+        self.assertEqual(context.exception.code, 503)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_not_found(self):
+        """Permanent error is not retried"""
+        self.server.faults['tile.zip'] = [{'status': 404}]
+        with self.assertRaises(urllib2.HTTPError):
+            self.download()
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_dropped_connections(self):
+        """Download continues after connections dropped without data"""
+        # three drops without data fail the first download attempt,
+        # the second attempt resumes after the last drop
+        self.server.faults['tile.zip'] = [{'drop_after': 0}] * 3 + [{'drop_after': 200000}]
+        self.download()
+        self.assertEqual(self.server.requests, [('tile.zip', None)] * 4 +
+                         [('tile.zip', 'bytes=200000-')])
+        self.assertEqual(self.server.bytes_sent, SIZE)
+        self.assertDownloaded()
+
+    def test_bad_etag(self):
+        """File with checksum not matching ETag is removed"""
+        self.server.faults['tile.zip'] = [{'etag': BAD_ETAG}]
+        with self.assertRaises(module.ChecksumError):
+            self.download(retries=0)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_bad_etag_retry(self):
+        """File with checksum not matching ETag is downloaded again"""
+        self.server.faults['tile.zip'] = [{'etag': BAD_ETAG}]
+        self.download()
+        self.assertEqual(self.server.requests, [('tile.zip', None)] * 2)
+        self.assertEqual(self.server.bytes_sent, 2 * SIZE)
+        self.assertDownloaded()
+
+
+class FailingTNMHandler(TNMHandler):
+    """Mock of TNM file server with tiles always unavailable"""
+
+    def send_tile(self, file_name):
+        if file_name in self.server.failing_files:
+            self.send_empty(503, [('Retry-After', '0')])
+            return
+        TNMHandler.send_tile(self, file_name)
+
+
+class TestFailedTile(TestCase):
+    """Failed tile is reported and the other tiles are patched"""
+
+    output = 'test_r_in_usgs_failed_tile'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.server = MockTNM(['ned'], 4, 64, directory=os.path.join(cls.directory, 'server'))
+        cls.server.RequestHandlerClass = FailingTNMHandler
+        cls.failed_tile = cls.server.tiles['ned'][1]
+        cls.server.failing_files = set([cls.failed_tile['file']])
+        cls.server.start()
+        os.environ['R_IN_USGS_TNM_URL'] = cls.server.api_url
+        # region of the tiles in the current location
+        west, south, east, north = cls.server.bbox('ned')
+        points = []
+        for corner in ((west, south), (east, north), (west, north), (east, south)):
+            point = gscript.read_command('m.proj', coordinates=corner, flags='i',
+                                         separator='comma')
+            points.append([float(coord) for coord in point.split(',')[:2]])
+        cls.use_temp_region()
+        cls.runModule('g.region', w=min(x for x, y in points), e=max(x for x, y in points),
+                      s=min(y for x, y in points), n=max(y for x, y in points),
+                      rows=128, cols=128)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.del_temp_region()
+        del os.environ['R_IN_USGS_TNM_URL']
+        cls.server.stop()
+        shutil.rmtree(cls.directory)
+
+    def tearDown(self):
+        self.runModule('g.remove', type='raster', name=self.output, flags='f')
+
+    def test_failed_tile(self):
+        """Failed download is in the summary, other tiles are patched"""
+        usgs = SimpleModule('r.in.usgs', product='ned', ned_dataset='ned13sec',
+                            output_name=self.output, retries=1, retry_time=1,
+                            query_cache_ttl=0,
+                            output_directory=os.path.join(self.directory, 'work'))
+        self.assertModule(usgs)
+        stderr = usgs.outputs.stderr
+        self.assertIn("1 of 4 tile(s) failed", stderr)
+        self.assertIn("{0}: download failed".format(self.failed_tile['title']), stderr)
+        self.assertIn("3 of 4 tile/s succesfully imported and patched", stderr)
+        self.assertRasterExists(self.output)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,153 @@
+"""
+Name:      test_download_resume
+Purpose:   Test resuming of interrupted downloads of r.in.usgs
+
+License:   This program is free software under the GNU General Public
+           License (>=v2). Read the file COPYING that comes with GRASS
+           for details.
+"""
+
+import os
+import imp
+import hashlib
+import shutil
+import tempfile
+
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+from tile_server import TileServer
+
+module = imp.load_source('r_in_usgs', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'r.in.usgs.py'))
+
+SIZE = 1024 * 1024
+
+
+class TestDownloadResume(TestCase):
+    """Download of a tile is resumed with HTTP Range requests"""
+
+    def setUp(self):
+        self.data = os.urandom(SIZE)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'tile.zip')
+
+    def tearDown(self):
+        module.close_connections()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def start_server(self, accept_ranges=True):
+        self.server = TileServer({'tile.zip': self.data}, accept_ranges).start()
+
+    def write_part(self, nbytes):
+        with open(self.path + '.part', 'wb') as part:
+            part.write(self.data[:nbytes])
+
+    def download(self):
+        progress = module.DownloadProgress(SIZE, 1)
+        info = module.download_file(self.server.url('tile.zip'), self.path,
+                                    progress, size=SIZE)
+        # bytes of repeated transfers are not counted twice
+        self.assertEqual(progress.done_bytes, SIZE)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        with open(self.path, 'rb') as tile:
+            self.assertTrue(tile.read() == self.data, msg="Downloaded data differ")
+        return info
+
+    def test_resume_part(self):
+        """Existing .part file is completed with the rest of the file"""
+        self.start_server()
+        self.write_part(300000)
+        self.download()
+        self.assertEqual(self.server.requests, [('tile.zip', 'bytes=300000-')])
+        self.assertEqual(self.server.bytes_sent, SIZE - 300000)
+
+    def test_resume_after_drop(self):
+        """Connection dropped during transfer is resumed in the same run"""
+        self.start_server()
+        self.server.faults['tile.zip'] = [{'drop_after': 400000}]
+        self.download()
+        self.assertEqual(self.server.requests, [('tile.zip', None),
+                                                ('tile.zip', 'bytes=400000-')])
+        self.assertEqual(self.server.bytes_sent, SIZE)
+
+    def test_complete_part(self):
+        """Complete .part file is accepted when the server responds with 416"""
+        self.start_server()
+        self.write_part(SIZE)
+        info = self.download()
+        self.assertEqual(self.server.requests, [('tile.zip', 'bytes={0}-'.format(SIZE))])
+        self.assertEqual(self.server.bytes_sent, 0)
+        self.assertEqual(info['checksum'], module.file_checksum(self.path).hexdigest())
+
+    def test_no_accept_ranges(self):
+        """Without Accept-Ranges, download starts again from the beginning"""
+        self.start_server(accept_ranges=False)
+        self.write_part(300000)
+        self.server.faults['tile.zip'] = [{'drop_after': 400000}]
+        self.download()
+        # range of the .part file is ignored, after the drop
+        # the server is not asked for a range any more
+        self.assertEqual(self.server.requests, [('tile.zip', 'bytes=300000-'),
+                                                ('tile.zip', None)])
+        self.assertEqual(self.server.bytes_sent, 400000 + SIZE)
+
+
+class TestChangedFile(TestCase):
+    """Partial download of a file changed on the server is not resumed"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'tile.zip')
+        self.manifest = module.TileManifest(os.path.join(self.directory, 'manifest.db'))
+        self.old_data = os.urandom(SIZE)
+
+    def tearDown(self):
+        module.close_connections()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def start_download(self, data):
+        # partial download of the old version recorded as started
+        with open(self.path + '.part', 'wb') as part:
+            part.write(self.old_data[:300000])
+        self.manifest.update(self.server.url('tile.zip'), size=SIZE,
+                             etag='"{0}"'.format(hashlib.md5(self.old_data).hexdigest()))
+        self.server.files['tile.zip'] = data
+
+    def download(self, data):
+        progress = module.DownloadProgress(len(data), 1)
+        module.download_tile(self.server.url('tile.zip'), self.path, len(data),
+                             progress, manifest=self.manifest)
+        with open(self.path, 'rb') as tile:
+            self.assertTrue(tile.read() == data, msg="Downloaded data differ")
+        self.assertEqual(self.manifest.get(self.server.url('tile.zip'))['size'], len(data))
+
+    def test_changed_size(self):
+        """Partial download is removed when TNM reports another size"""
+        self.server = TileServer({}).start()
+        data = os.urandom(SIZE + 1000)
+        self.start_download(data)
+        self.download(data)
+        self.assertEqual(self.server.requests, [('tile.zip', None)])
+
+    def test_changed_etag(self):
+        """Whole file is sent when ETag in If-Range does not match"""
+        self.server = TileServer({}).start()
+        data = os.urandom(SIZE)
+        self.start_download(data)
+        self.download(data)
+        self.assertEqual(self.server.requests, [('tile.zip', 'bytes=300000-')])
+        self.assertEqual(self.server.bytes_sent, SIZE)
+
+    def test_same_etag(self):
+        """Partial download of unchanged file is resumed"""
+        self.server = TileServer({}).start()
+        self.start_download(self.old_data)
+        self.download(self.old_data)
+        self.assertEqual(self.server.bytes_sent, SIZE - 300000)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,103 @@
+"""
+Local HTTP server of files for tests of r.in.usgs downloads
+
+Files are served from memory with byte ranges (unless disabled,
+If-Range is honoured) and MD5 ETag, like the USGS file servers. Faults to be injected into
+the next responses are given per file, each fault is a dictionary:
+
+    {'drop_after': bytes}  connection is closed after sending bytes of data
+    {'status': code, 'headers': [(name, value)]}  error response is sent
+    {'etag': etag}  data are sent with the given ETag
+"""
+
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_empty(self, code, headers=()):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        name = self.path.lstrip('/')
+        range_header = self.headers.getheader('Range')
+        with server.lock:
+            server.requests.append((name, range_header))
+            faults = server.faults.get(name)
+            fault = faults.pop(0) if faults else {}
+        data = server.files.get(name)
+        if 'status' in fault:
+            self.send_empty(fault['status'], fault.get('headers', ()))
+            return
+        if data is None:
+            self.send_empty(404)
+            return
+        start = 0
+        etag = '"{0}"'.format(hashlib.md5(data).hexdigest())
+        if_range = self.headers.getheader('If-Range')
+        if if_range and if_range != etag:
+            # file changed, it is sent whole
+            range_header = None
+        if range_header and server.accept_ranges:
+            start = int(range_header[len('bytes='):].split('-')[0])
+            if start >= len(data):
+                self.send_empty(416, [('Content-Range', 'bytes */{0}'.format(len(data)))])
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        if server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', fault.get('etag', etag))
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:start + fault.get('drop_after', len(data))]
+        self.wfile.write(body)
+        with server.lock:
+            server.bytes_sent += len(body)
+        if 'drop_after' in fault:
+            self.wfile.flush()
+            self.close_connection = 1
+
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded server of files given as a dictionary of name and data"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, files, accept_ranges=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TileHandler)
+        self.files = files
+        self.accept_ranges = accept_ranges
+        self.faults = {}
+        self.requests = []
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def url(self, name):
+        return 'http://127.0.0.1:{0}/{1}'.format(self.server_port, name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()